@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+'''
+Benchmarks of the version matching helpers and of GemDeps.process.
+
+Rubygems is replaced by a local HTTP server answering from recorded or
+synthetic dependencies.json payloads, and rmadison and wnpp-check by the
+scripts in benchmarks/bin, which answer from a JSON map of packages. No
+network access is needed, so that results of different runs and releases
+can be compared.
+
+Usage::
+
+    python benchmarks/bench.py run --fixture rails --save NAME
+    python benchmarks/bench.py run --synthetic 500 --compare results/OLD.json
+    python benchmarks/bench.py record path/to/Gemfile fixtures/NAME
+'''
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+import types
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import gemdeps  # noqa: E402
+from gemdeps import util  # noqa: E402
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    '''
+    Answers /api/v1/dependencies.json?gems=a,b like rubygems.org does, from
+    the payloads of the server.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != gemdeps.RUBYGEMS_API:
+            self.send_error(404)
+            return
+        names = parse_qs(url.query).get('gems', [''])[0].split(',')
+        versions = []
+        for name in names:
+            versions.extend(self.server.payloads.get(name, []))
+        body = json.dumps(versions).encode('utf-8')
+        self.server.requests = self.server.requests + 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextlib.contextmanager
+def stand_ins(payloads, debian):
+    '''
+    Start the Rubygems server and put the rmadison and wnpp-check scripts
+    first in PATH. Yields the server, whose url attribute is the base URL
+    to give to RubygemsClient.
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.payloads = payloads
+    server.requests = 0
+    server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    tmp_dir = tempfile.mkdtemp()
+    debian_path = os.path.join(tmp_dir, 'debian.json')
+    with open(debian_path, 'w') as f:
+        json.dump(debian, f)
+    environ = dict(os.environ)
+    os.environ['PATH'] = os.path.join(BENCH_DIR, 'bin') + os.pathsep + \
+        os.environ['PATH']
+    os.environ['GEMDEPS_BENCH_DEBIAN'] = debian_path
+    try:
+        yield server
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmp_dir)
+
+
+def load_fixture(name):
+    '''
+    Return the payloads, Debian map and Gemfile path of a recorded fixture,
+    given by name or path.
+    '''
+    path = name
+    if not os.path.isdir(path):
+        path = os.path.join(BENCH_DIR, 'fixtures', name)
+    with open(os.path.join(path, 'dependencies.json')) as f:
+        payloads = json.load(f)
+    with open(os.path.join(path, 'debian.json')) as f:
+        debian = json.load(f)
+    return payloads, debian, os.path.join(path, 'Gemfile')
+
+
+def random_version(rng, prerelease=False):
+    '''
+    Return a random version string.
+    '''
+    version = '%d.%d.%d' % (rng.randint(0, 5), rng.randint(0, 12),
+                            rng.randint(0, 20))
+    if prerelease:
+        version = version + '.%s%d' % (rng.choice(['beta', 'rc']),
+                                       rng.randint(1, 3))
+    return version
+
+
+def random_requirement(rng, versions):
+    '''
+    Return a random requirement that at least one of versions satisfies.
+    '''
+    released = [x for x in versions if not util.is_prerelease(x)]
+    version = rng.choice(released)
+    major, minor = version.split('.')[:2]
+    choice = rng.randint(0, 5)
+    if choice == 0:
+        return ['>= 0']
+    elif choice == 1:
+        return ['>= %s' % version]
+    elif choice == 2:
+        return ['~> %s.%s' % (major, minor)]
+    elif choice == 3:
+        return ['~> %s' % version]
+    elif choice == 4:
+        return ['>= %s' % version, '< %d' % (int(major) + 1)]
+    return ['= %s' % version]
+
+
+def synthetic_fixture(gems, versions, seed, path):
+    '''
+    Generate a random dependency graph of gems gems with versions versions
+    each, where gems only depend on gems with a higher number, and write its
+    Gemfile to path. Returns the payloads and Debian map.
+    '''
+    rng = random.Random(seed)
+    names = ['gem%04d' % number for number in range(gems)]
+    numbers = {}
+    for name in names:
+        numbers[name] = set([random_version(rng)])
+        while len(numbers[name]) < versions:
+            numbers[name].add(random_version(rng, rng.random() < 0.1))
+        numbers[name] = sorted(numbers[name])
+    payloads = {}
+    for position, name in enumerate(names):
+        payloads[name] = []
+        candidates = names[position + 1:position + 40]
+        for number in numbers[name]:
+            dependencies = []
+            for dependency in rng.sample(candidates,
+                                         min(len(candidates),
+                                             rng.randint(0, 4))):
+                dependencies.append(
+                    [dependency, ', '.join(random_requirement(
+                        rng, numbers[dependency]))])
+            payloads[name].append({'name': name,
+                                   'number': number,
+                                   'platform': 'ruby',
+                                   'dependencies': dependencies})
+    debian = {'unstable': {}, 'experimental': {}, 'new': {}, 'itp': {}}
+    for name in names:
+        package = 'ruby-' + name
+        choice = rng.random()
+        if choice < 0.5:
+            debian['unstable'][package] = rng.choice(numbers[name]) + '-1'
+        elif choice < 0.6:
+            debian['experimental'][package] = numbers[name][-1] + '-1'
+        elif choice < 0.65:
+            debian['new'][package] = numbers[name][-1] + '-1'
+        elif choice < 0.7:
+            debian['itp'][package] = str(800000 + rng.randint(0, 99999))
+    with open(path, 'w') as f:
+        f.write("source 'https://rubygems.org'\n\n")
+        for name in names[:max(1, gems // 10)]:
+            requirement = random_requirement(rng, numbers[name])
+            f.write("gem '%s', %s\n" % (name, ', '.join(
+                "'%s'" % x for x in requirement)))
+    return payloads, debian
+
+
+def clear_caches():
+    '''
+    Clear the memoized helpers of gemdeps.util, so that cold calls are
+    measured.
+    '''
+    for function in (util.parse_requirement, util.version_segments,
+                     util.version_key, util.bump_key,
+                     util.compile_requirement, util.merge_requirements):
+        function.cache_clear()
+
+
+def matching_cases(payloads):
+    '''
+    Collect the inputs of the matching helpers from the payloads: every
+    requirement of a dependency with the name and versions of the gem it
+    names, and pairs of requirements on the same gem.
+    '''
+    versions = {}
+    for name, payload in payloads.items():
+        versions[name] = sorted(set(x['number'] for x in payload))
+    requirements = {}
+    for payload in payloads.values():
+        for gem_version in payload:
+            for name, requirement in gem_version['dependencies']:
+                if versions.get(name):
+                    requirements.setdefault(name, []).append(
+                        [x.strip() for x in requirement.split(',')])
+    cases = []
+    pairs = []
+    for name, name_requirements in sorted(requirements.items()):
+        for requirement in name_requirements:
+            cases.append((name, requirement, versions[name]))
+        for requirement1, requirement2 in zip(name_requirements,
+                                              name_requirements[1:]):
+            pairs.append((requirement1, requirement2))
+    return cases, pairs, versions
+
+
+def time_pass(function, repeat):
+    '''
+    Return the best time of repeat cold calls of function.
+    '''
+    return min(timeit.repeat(function, setup=clear_caches, repeat=repeat,
+                             number=1))
+
+
+def bench_matching(payloads, repeat):
+    '''
+    Time the version matching helpers over all requirements in the
+    payloads. Each result is the time of one pass over all cases.
+    '''
+    cases, pairs, versions = matching_cases(payloads)
+    if not cases:
+        return {}
+
+    def satisfy():
+        for name, requirement, version_list in cases:
+            for version in version_list:
+                util.version_satisfy_requirement(requirement, version)
+
+    def least():
+        # Like GemDeps.process, with the VersionIndex of each gem built on
+        # its first lookup
+        app = gemdeps.GemDeps('bench', archive=object(), client=object())
+        for name, requirement, version_list in cases:
+            gem = types.SimpleNamespace(name=name, requirement=requirement)
+            try:
+                app.smallest_satisfiable(payloads[name], gem)
+            except ValueError:
+                pass
+
+    def stricter():
+        for requirement1, requirement2 in pairs:
+            util.get_stricter(requirement1, requirement2)
+
+    def merge():
+        for requirement1, requirement2 in pairs:
+            util.merge_requirements(tuple(requirement1), tuple(requirement2))
+
+    def index_least():
+        indexes = {}
+        for name, requirement, version_list in cases:
+            key = id(version_list)
+            if key not in indexes:
+                indexes[key] = util.VersionIndex(version_list)
+            indexes[key].least(requirement)
+
+    checks = sum(len(version_list)
+                 for name, requirement, version_list in cases)
+    results = {}
+    for name, function, count in (
+            ('version_satisfy_requirement', satisfy, checks),
+            ('least_satisfiable_version', least, len(cases)),
+            ('get_stricter', stricter, len(pairs)),
+            ('merge_requirements', merge, len(pairs)),
+            ('VersionIndex.least', index_least, len(cases))):
+        seconds = time_pass(function, repeat)
+        results[name + '.seconds'] = seconds
+        results[name + '.calls_per_second'] = count / seconds
+    return results
+
+
+def run_process(server, gemfile, workers, matching_pool=None):
+    '''
+    Resolve gemfile against the stand-ins and return the GemDeps object.
+    '''
+    client = gemdeps.RubygemsClient(base_url=server.url,
+                                    pool_size=max(workers, 1))
+    if matching_pool is not None:
+        matching_pool.clear()
+    gemdeps_object = gemdeps.GemDeps('bench', workers=workers,
+                                     client=client,
+                                     matching_pool=matching_pool)
+    gemdeps_object.process(gemfile)
+    return gemdeps_object
+
+
+def bench_process(payloads, debian, gemfile, workers, repeat,
+                  matching_pool=None):
+    '''
+    Time full runs of GemDeps.process, and measure the peak memory of one
+    more run separately, as tracing slows it down.
+    '''
+    results = {}
+    with stand_ins(payloads, debian) as server:
+        times = []
+        for iteration in range(repeat):
+            clear_caches()
+            server.requests = 0
+            start = time.time()
+            gemdeps_object = run_process(server, gemfile, workers,
+                                         matching_pool)
+            times.append(time.time() - start)
+        gems = len(gemdeps_object.dependency_list)
+        results['process.seconds'] = min(times)
+        results['process.gems'] = gems
+        results['process.gems_per_second'] = gems / min(times)
+        results['process.rubygems_requests'] = server.requests
+        clear_caches()
+        tracemalloc.start()
+        run_process(server, gemfile, workers, matching_pool)
+        results['process.peak_memory_bytes'] = \
+            tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return results
+
+
+def compare(report, path):
+    '''
+    Print the change of each result against the results saved in path.
+    '''
+    with open(path) as f:
+        old_report = json.load(f)
+    if old_report['fixture'] != report['fixture']:
+        print("Warning: %s was run on fixture %s, not %s" %
+              (path, old_report['fixture'], report['fixture']))
+    old = old_report['results']
+    results = report['results']
+    print("%-45s %14s %14s %9s" % ('benchmark', 'old', 'new', 'change'))
+    for key in sorted(results):
+        if key not in old:
+            continue
+        change = ''
+        if old[key]:
+            change = '%+.1f%%' % ((results[key] - old[key]) * 100.0 /
+                                  old[key])
+        print("%-45s %14.6g %14.6g %9s" % (key, old[key], results[key],
+                                           change))
+
+
+def run(args):
+    '''
+    Run the benchmarks on a fixture, print the results and save or compare
+    them.
+    '''
+    tmp_dir = tempfile.mkdtemp()
+    matching_pool = None
+    if args.processes is not None:
+        matching_pool = gemdeps.MatchingPool(args.processes or None)
+    try:
+        if args.synthetic:
+            gemfile = os.path.join(tmp_dir, 'Gemfile')
+            payloads, debian = synthetic_fixture(args.synthetic,
+                                                 args.versions, args.seed,
+                                                 gemfile)
+            fixture = 'synthetic-%d-%d-%d' % (args.synthetic, args.versions,
+                                              args.seed)
+        else:
+            payloads, debian, gemfile = load_fixture(args.fixture)
+            fixture = args.fixture
+        results = bench_matching(payloads, args.repeat)
+        results.update(bench_process(payloads, debian, gemfile,
+                                     args.workers, args.repeat,
+                                     matching_pool))
+    finally:
+        if matching_pool is not None:
+            matching_pool.close()
+        shutil.rmtree(tmp_dir)
+    report = {'fixture': fixture,
+              'python': platform.python_version(),
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'workers': args.workers,
+              'processes': args.processes,
+              'results': results}
+    if args.compare:
+        compare(report, args.compare)
+    else:
+        print(json.dumps(report, indent=4, sort_keys=True))
+    if args.save:
+        results_dir = os.path.join(BENCH_DIR, 'results')
+        if not os.path.isdir(results_dir):
+            os.makedirs(results_dir)
+        with open(os.path.join(results_dir, args.save + '.json'), 'w') as f:
+            f.write(json.dumps(report, indent=4, sort_keys=True))
+
+
+def record(args):
+    '''
+    Resolve a Gemfile against rubygems.org and rmadison, and save the
+    payloads and packaging information that were used as a fixture.
+    '''
+    gemdeps_object = gemdeps.GemDeps('record')
+    gemdeps_object.process(args.gemfile)
+    archive = gemdeps_object.archive
+    debian = {'unstable': {}, 'experimental': {}, 'new': {}, 'itp': {}}
+    for package, versions in archive.versions.items():
+        for suite, version in versions.items():
+            if suite in debian:
+                debian[suite][package] = version
+    for package, bug in archive.wnpp.items():
+        if bug is not None and bug[0] == 'ITP':
+            debian['itp'][package] = bug[1]
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    with open(os.path.join(args.output, 'dependencies.json'), 'w') as f:
+        f.write(json.dumps(gemdeps_object.gem_info, indent=1,
+                           sort_keys=True) + '\n')
+    with open(os.path.join(args.output, 'debian.json'), 'w') as f:
+        f.write(json.dumps(debian, indent=1, sort_keys=True) + '\n')
+    shutil.copy(args.gemfile, os.path.join(args.output, 'Gemfile'))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of gemdeps, run against local stand-ins "
+        "of Rubygems and rmadison")
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help="Run the benchmarks")
+    run_parser.add_argument('-f', '--fixture', default='rails',
+                            help="Name or path of a recorded fixture")
+    run_parser.add_argument('--synthetic', type=int, metavar='GEMS',
+                            help="Use a random graph of GEMS gems instead")
+    run_parser.add_argument('--versions', type=int, default=20,
+                            help="Versions per synthetic gem")
+    run_parser.add_argument('--seed', type=int, default=0,
+                            help="Seed of the synthetic graph")
+    run_parser.add_argument('-r', '--repeat', type=int, default=5,
+                            help="Runs of each benchmark, the best is kept")
+    run_parser.add_argument('-w', '--workers', type=int, default=1)
+    run_parser.add_argument('-p', '--processes', type=int,
+                            help="Select versions in a MatchingPool of this "
+                            "many processes (0: one per CPU)")
+    run_parser.add_argument('--save', metavar='NAME',
+                            help="Save results to results/NAME.json")
+    run_parser.add_argument('--compare', metavar='FILE',
+                            help="Print the change against saved results")
+    record_parser = subparsers.add_parser(
+        'record', help="Record a fixture from rubygems.org and rmadison")
+    record_parser.add_argument('gemfile')
+    record_parser.add_argument('output', help="Fixture directory")
+    args = parser.parse_args()
+    # Only the results are printed: the progress of each run is not shown,
+    # and random graphs have many conflicting requirements
+    logging.getLogger('gemdeps').setLevel(logging.ERROR)
+    if args.command == 'record':
+        record(args)
+    elif args.command == 'run':
+        run(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,80 @@
 #!/usr/bin/env python
 
-import copy
+import importlib
 import json
+import logging
 import os
+import time
+from collections import deque
 
-from gemfileparser import GemfileParser
+from .metrics import Metrics
+from .util import (GEM_EXCEPTIONS, SKIP_VERSION_CHECK, VersionIndex,
+                   merge_requirements, version_satisfy_requirement)
 
-from .util import (GEM_EXCEPTIONS, SKIP_VERSION_CHECK, get_stricter,
-                   least_satisfiable_version, version_satisfy_requirement)
+# Modules that pull in gemfileparser, asyncio, sqlite3 or http.client are
+# only imported when one of their classes is first used, so that importing
+# gemdeps stays cheap
+LAZY_ATTRIBUTES = {'DependencyCache': 'cache',
+                   'GemDepsDaemon': 'daemon',
+                   'StatusCache': 'cache',
+                   'CachedArchive': 'debian',
+                   'CommandRunner': 'debian',
+                   'LocalArchive': 'debian',
+                   'MadisonArchive': 'debian',
+                   'WnppIndex': 'debian',
+                   'Lockfile': 'lockfile',
+                   'MatchingPool': 'matching',
+                   'Resolver': 'resolver',
+                   'CompactIndex': 'rubygems',
+                   'RubygemsClient': 'rubygems'}
 
-try:
-    from urllib.request import urlopen
-except:
-    from urllib2 import urlopen
+log = logging.getLogger(__name__)
+
+STATUS_ATTRIBUTES = ('version', 'suite', 'status', 'link', 'satisfied',
+                     'color')
+
+# Suite of the StatusCache whose expiry applies to a saved status
+STATE_SUITES = {'Unstable': 'unstable',
+                'Experimental': 'experimental',
+                'NEW': 'new'}
+RUBYGEMS_API = '/api/v1/dependencies.json'
+
+
+def __getattr__(name):
+    '''
+    Import the module of a class listed in LAZY_ATTRIBUTES when it is first
+    accessed as gemdeps.<name>.
+    '''
+    if name in LAZY_ATTRIBUTES:
+        module = importlib.import_module('.' + LAZY_ATTRIBUTES[name],
+                                         __name__)
+        return getattr(module, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def default_services(workers, archive, client, metrics):
+    '''
+    Returns the archive, client and metrics given to GemDeps or
+    GemDepsBatch, with a MadisonArchive, a RubygemsClient and a Metrics
+    created for those that are None.
+    '''
+    if metrics is None:
+        metrics = Metrics()
+    if archive is None:
+        from .debian import CommandRunner, MadisonArchive
+        archive = MadisonArchive(runner=CommandRunner(metrics=metrics))
+    if client is None:
+        from .rubygems import RubygemsClient
+        client = RubygemsClient(pool_size=max(workers, 1), metrics=metrics)
+    return archive, client, metrics
+
+
+def new_dependency():
+    '''
+    Returns an empty GemfileParser.Dependency.
+    '''
+    from gemfileparser import GemfileParser
+    return GemfileParser.Dependency()
 
 
 class DetailedDependency(object):
@@ -21,12 +83,28 @@ class DetailedDependency(object):
       * Rubygem specific information
       * Debian packaging information
       * Rquirement Satisfaction information
+
+    Attributes are kept in slots, as large dependency graphs have many
+    instances.
     '''
 
-    def __init__(self, original_dep=GemfileParser.Dependency()):
+    __slots__ = ('archive', 'name', 'requirement', 'autorequire', 'source',
+                 'parent', 'group', 'color', 'version', 'status', 'suite',
+                 'satisfied', 'link', 'debian_name')
+
+    def __init__(self, original_dep=None, archive=None):
         '''
         Initialize attributes.
+
+        archive is the source of Debian packaging information. It can be
+        shared between instances so that lookups are done only once.
         '''
+        if original_dep is None:
+            original_dep = new_dependency()
+        if archive is None:
+            from .debian import MadisonArchive
+            archive = MadisonArchive()
+        self.archive = archive
         self.name = original_dep.name
         self.requirement = original_dep.requirement
         self.autorequire = original_dep.autorequire
@@ -41,6 +119,13 @@ class DetailedDependency(object):
         self.link = ''
         self.debian_name = self.get_debian_name()
 
+    def to_dict(self):
+        '''
+        Returns the information about the gem as a dict.
+        '''
+        return dict((key, getattr(self, key)) for key in self.__slots__
+                    if key != 'archive')
+
     def get_debian_name(self):
         '''
         Returns debian specific name of the gem.
@@ -59,110 +144,63 @@ class DetailedDependency(object):
             debian_name = "ruby-" + hyphen_name
             return debian_name
 
+    def is_in_suite(self, suite):
+        '''
+        Set version and link from the archive if the package is in suite.
+        '''
+        version = self.archive.get_version(self.debian_name, suite)
+        if version:
+            self.version = version
+            if suite == 'new':
+                self.link = "https://ftp-master.debian.org/new/%s_%s.html" % (
+                    self.debian_name, self.version)
+            else:
+                self.link = "https://tracker.debian.org/pkg/%s" % \
+                    self.debian_name
+        else:
+            self.version = "NA"
+            self.suite = "Unpackaged"
+            self.status = "Unpackaged"
+
     def is_in_unstable(self):
         '''
         Check if the dependency is satisfied in unstable.
         '''
-        rmadison_output = os.popen(
-            'rmadison -s unstable -a amd64,all %s 2>&1' % self.debian_name)
-        rmadison_output = rmadison_output.read()
-        count = 0
-        if "curl:" in rmadison_output:
-            # If curl returns an error, repeat the steps
-            while "curl:" in rmadison_output:
-                count = count + 1
-                rmadison_output = os.popen(
-                    'rmadison -s unstable -a amd64,all %s 2>&1'
-                    % self.debian_name)
-                rmadison_output = rmadison_output.read()
         self.suite = "Unstable"
         self.status = "Packaged"
-        try:
-            self.version = rmadison_output.split("|")[1].strip()
-            self.link = "https://tracker.debian.org/pkg/%s" % self.debian_name
-        except:
-            self.version = "NA"
-            self.suite = "Unpackaged"
-            self.status = "Unpackaged"
+        self.is_in_suite('unstable')
 
     def is_in_experimental(self):
         '''
         Check if the dependency is satisfied in experimental.
         '''
-        rmadison_output = os.popen(
-            'rmadison -s experimental -a amd64,all %s 2>&1' % self.debian_name)
-        rmadison_output = rmadison_output.read()
-        count = 0
-        if "curl:" in rmadison_output:
-            while "curl:" in rmadison_output:
-                count = count + 1
-                rmadison_output = os.popen(
-                    'rmadison -s experimental -a amd64,all %s 2>&1'
-                    % self.debian_name)
-                rmadison_output = rmadison_output.read()
         self.suite = "Experimental"
         self.status = "Packaged"
-        try:
-            self.version = rmadison_output.split("|")[1].strip()
-            self.link = "https://tracker.debian.org/pkg/%s" % self.debian_name
-        except:
-            self.version = "NA"
-            self.suite = "Unpackaged"
-            self.status = "Unpackaged"
+        self.is_in_suite('experimental')
 
     def is_in_new(self):
         '''
         Check if the package is still in the NEW queue.
         '''
-        rmadison_output = os.popen(
-            'rmadison -s new -a amd64,all %s 2>&1' % self.debian_name)
-        rmadison_output = rmadison_output.read()
-        count = 0
-        if "curl:" in rmadison_output:
-            while "curl:" in rmadison_output:
-                count = count + 1
-                rmadison_output = os.popen(
-                    'rmadison -s new -a amd64,all %s 2>&1'
-                    % self.debian_name)
-                rmadison_output = rmadison_output.read()
         self.suite = "NEW"
         self.status = "NEW"
-        try:
-            self.version = rmadison_output.split("|")[1].strip()
-            self.link = "https://ftp-master.debian.org/new/%s_%s.html" % (
-                self.debian_name, self.version)
-        except:
-            self.version = "NA"
-            self.suite = "Unpackaged"
-            self.status = "Unpackaged"
+        self.is_in_suite('new')
 
     def is_itp(self):
         '''
         Check if the dependency has an open ITP against it.
         '''
-        wnpp_output = os.popen('wnpp-check %s' % self.debian_name)
-        wnpp_output = wnpp_output.read()
-        count = 0
-        if "curl:" in wnpp_output:
-            while "curl:" in wnpp_output:
-                count = count + 1
-                wnpp_output = os.popen('wnpp-check %s' % self.debian_name)
-                wnpp_output = wnpp_output.read()
+        bug = self.archive.get_wnpp(self.debian_name)
         self.version = "NA"
-        if wnpp_output == "":
+        if bug is None:
             self.suite = "Unpackaged"
             self.status = "Unpackaged"
         else:
-            pos1 = wnpp_output.index('#')
-            pos2 = wnpp_output.index(')')
-            if 'ITP' in wnpp_output:
-                self.suite = "ITP"
-                self.status = "ITP"
-            elif 'RFP' in wnpp_output:
-                self.suite = "RFP"
-                self.status = "RFP"
-            self.link = "https://bugs.debian.org/%s" % wnpp_output[
-                pos1 + 1:pos2]
+            bug_type, number = bug
+            if bug_type in ('ITP', 'RFP'):
+                self.suite = bug_type
+                self.status = bug_type
+            self.link = "https://bugs.debian.org/%s" % number
 
     def set_color(self):
         '''
@@ -186,20 +224,24 @@ class DetailedDependency(object):
 
     def version_check(self):
         '''
-        Returns if debian_version satisfies gem_requirement.
+        Sets if debian_version satisfies gem_requirement.
+        '''
+        self.satisfied = self.satisfies(self.version, self.status)
+
+    def satisfies(self, debian_version, status):
+        '''
+        Returns if a Debian version with the given packaging status
+        satisfies gem_requirement.
         '''
-        gem_requirement, debian_version = self.requirement, self.version
+        gem_requirement = self.requirement
 
         if self.name in SKIP_VERSION_CHECK:
-            self.satisfied = True
-            return
+            return True
 
-        if gem_requirement == [] and self.status == 'Packaged':
-            self.satisfied = True
-            return
+        if gem_requirement == [] and status == 'Packaged':
+            return True
         if debian_version == 'NA':
-            self.satisfied = False
-            return
+            return False
 
         # Cleaning up version status in Debian
         if ":" in debian_version:
@@ -212,14 +254,8 @@ class DetailedDependency(object):
         elif '+' in debian_version:
             debian_version = debian_version[:debian_version.index('+')]
 
-        # Cleaning up version requirement in gem
-        # requirement = gem_requirement.split(',')
-        # requirement = [x.strip() for x in requirement]
-
         # Perform comparison
-        status = True
-        status = version_satisfy_requirement(gem_requirement, debian_version)
-        self.satisfied = status
+        return version_satisfy_requirement(gem_requirement, debian_version)
 
     def debian_status(self, jsoncontent={}):
         '''
@@ -229,12 +265,8 @@ class DetailedDependency(object):
             self.version = jsoncontent[self.name]['version']
             self.suite = jsoncontent[self.name]['suite']
             self.link = jsoncontent[self.name]['link']
-            if self.suite == 'Unpackaged':
-                self.status = "Unpackaged"
-            elif self.suite == 'ITP':
-                self.status = "ITP"
-            elif self.suite == 'RFP':
-                self.status = "RFP"
+            if self.suite in ('Unpackaged', 'NEW', 'ITP', 'RFP'):
+                self.status = self.suite
             else:
                 self.status = "Packaged"
         else:
@@ -247,16 +279,13 @@ class DetailedDependency(object):
                 self.is_itp()
         self.version_check()
         if not self.satisfied:
-            tmp = copy.deepcopy(self)
-            tmp.suite = ''
-            tmp.satisfied = ''
-            tmp.version = ''
-            tmp.is_in_experimental()
-            tmp.version_check()
-            if tmp.satisfied:
-                self.version = tmp.version
-                self.suite = tmp.suite
-                self.satisfied = tmp.satisfied
+            # A newer version in experimental may satisfy the requirement
+            version = self.archive.get_version(self.debian_name,
+                                               'experimental')
+            if version and self.satisfies(version, 'Packaged'):
+                self.version = version
+                self.suite = 'Experimental'
+                self.satisfied = True
         self.set_color()
 
 
@@ -265,14 +294,54 @@ class GemDeps(object):
     Main Class to generate dependency list of a Ruby (on Rails) app.
     '''
 
-    def __init__(self, appname, ignoresatisfied=True):
+    def __init__(self, appname, ignoresatisfied=True, workers=1,
+                 archive=None, cache=None, batch_size=50, client=None,
+                 metadata=None, metrics=None, matching_pool=None):
         '''
         Initialize necessary attributes.
+
+        archive is the source of Debian packaging information, by default a
+        MadisonArchive. A LocalArchive can be used to work offline.
+
+        If cache is a DependencyCache, Rubygems API responses are stored in
+        it and reused across runs.
+
+        Rubygems information of all gems in a level of the dependency tree is
+        fetched batch_size gems per request, through client, a RubygemsClient
+        by default. If workers is greater than 1, that many requests are sent
+        concurrently.
+
+        If metadata is a CompactIndex, Rubygems information is read from it
+        instead of the API.
+
+        The duration of each phase of a run and counters like cache hits are
+        recorded in metrics, a Metrics. It should be shared with the client
+        and the CommandRunner of archive, which record their own requests.
+
+        If matching_pool is a MatchingPool, the versions of all gems in a
+        level of the dependency tree are selected in its worker processes.
         '''
         self.appname = appname
         self.original_list = []
         self.dependency_list = {}
         self.ignoresatisfied = ignoresatisfied
+        self.workers = workers
+        self.archive, self.client, self.metrics = default_services(
+            workers, archive, client, metrics)
+        self.cache = cache
+        self.gem_info = {}
+        self.version_index = {}
+        self.selected = {}
+        self.resolved = {}
+        self.counted = set()
+        self.jsoncontent = {}
+        self.checked = {}
+        self.batch_size = batch_size
+        self.metadata = metadata
+        self.matching_pool = matching_pool
+        self.status_stream = None
+        self.dot_stream = None
+        self.pinned = {}
 
     def process(self, path):
         '''
@@ -291,83 +360,538 @@ class GemDeps(object):
                i. Get the runtime dependencies of "dep" from Rubygems API
                   at https://rubygems.org/api/v1/dependencies.json
                ii. Add each runtime dependency to dependency_list
+
+        Gems are visited breadth first from a queue. nodes maps the name of
+        each gem seen so far to its entry, which holds the merged requirement
+        and parents, so that a gem reached again is merged in constant time.
+
+        Before a new level of the tree is processed, the packaging status and
+        Rubygems information of all its gems are fetched in batches by
+        prefetch. The steps above still run one gem at a time in queue order,
+        so the result is the same as that of a serial run.
+
+        The packaging status and dependencies found for a gem and requirement
+        are reused whenever the same pair is reached again. After load_state,
+        this includes the pairs of the saved run, so only gems added to or
+        changed in the Gemfile, and the gems below them, are looked up.
         '''
-        self.parser = GemfileParser(path, appname=self.appname)
-        # self.cached_info = self.get_cache_content()
-        parsed = self.parser.parse_gemfile(path)
+        self.parse_gemfile(path)
+        self.walk(self.get_dependencies)
+
+    def parse_gemfile(self, path):
+        '''
+        Set original_list to the runtime dependencies listed in a Gemfile.
+        '''
+        from gemfileparser import GemfileParser
+        with self.metrics.timer('parse_gemfile'):
+            self.parser = GemfileParser(path, appname=self.appname)
+            parsed = self.parser.parse_gemfile(path)
         self.original_list = parsed['runtime'] + parsed['production']
-        self.original_list_name = [x.name for x in self.original_list]
-        counter = 0
-        while True:
-            try:
-                current_gem = DetailedDependency(self.original_list[counter])
-                print("Current Gem: %s" % current_gem.name)
-                if "rails-assets" in current_gem.name:
-                    print("\tRails Assets Found. Skipping")
-                    counter = counter + 1
+
+    def walk(self, get_dependencies, gem_info=True):
+        '''
+        Visit the gems of original_list and their dependencies, as returned
+        by get_dependencies for a gem, breadth first, setting their
+        packaging status. If gem_info is false, get_dependencies does not
+        need Rubygems information, so it is not prefetched.
+        '''
+        self.nodes = {}
+        queue = deque()
+        for dep in self.original_list:
+            if self.add_node(dep):
+                queue.append(dep)
+        level_size = 0
+        while queue:
+            if level_size == 0:
+                level_size = len(queue)
+                with self.metrics.timer('prefetch'):
+                    self.prefetch(list(queue), gem_info)
+            level_size = level_size - 1
+            current_gem = DetailedDependency(queue.popleft(), self.archive)
+            log.info("Current Gem: %s", current_gem.name)
+            if "rails-assets" in current_gem.name:
+                log.info("\tRails Assets Found. Skipping")
+                continue
+            self.set_status(current_gem)
+            self.dependency_list[current_gem.name] = current_gem
+            self.metrics.increment('gems_processed')
+            self.stream_gem(current_gem)
+            if current_gem.satisfied and self.ignoresatisfied:
+                log.info("%s is satisfied in %s", current_gem.name,
+                         current_gem.suite)
+            else:
+                gem_dependencies = get_dependencies(current_gem)
+                for dep in gem_dependencies:
+                    dep.parent.append(current_gem.name)
+                    if self.add_node(dep):
+                        queue.append(dep)
+
+    def add_node(self, dep):
+        '''
+        Add a dependency to nodes, or merge its requirement and parents into
+        the node of the same name. Returns if a new node was added.
+
+        Requirements are merged into the requirements allowing only the
+        versions that satisfy both. If no version can, the new requirement
+        replaces the old one, as the walk does not backtrack.
+        '''
+        node = self.nodes.get(dep.name)
+        if node is None:
+            self.nodes[dep.name] = dep
+            return True
+        merged = merge_requirements(tuple(node.requirement),
+                                    tuple(dep.requirement))
+        if merged is None:
+            log.warning("Requirements %s and %s on %s conflict, using %s",
+                        node.requirement, dep.requirement, dep.name,
+                        dep.requirement)
+            node.requirement = dep.requirement
+        else:
+            node.requirement = list(merged)
+        for parent in dep.parent:
+            if parent not in node.parent:
+                node.parent.append(parent)
+                if dep.name in self.dependency_list:
+                    self.stream_edge(parent, dep.name)
+        return False
+
+    def set_status(self, gem):
+        '''
+        Set packaging status of a gem. The status found earlier for the same
+        gem and requirement, in this run or a saved one, is reused.
+        '''
+        key = (gem.name, tuple(gem.requirement))
+        if key in self.resolved:
+            self.count_reused('status_reused', key)
+            for attribute, value in self.resolved[key].items():
+                setattr(gem, attribute, value)
+        else:
+            with self.metrics.timer('debian_status'):
+                gem.debian_status(self.jsoncontent)
+            if gem.name not in self.jsoncontent:
+                self.checked[gem.name] = time.time()
+            self.counted.add(('status_reused', key))
+            self.resolved[key] = dict(
+                (attribute, getattr(gem, attribute))
+                for attribute in STATUS_ATTRIBUTES)
+
+    def count_reused(self, counter, key):
+        '''
+        Count a status or selection in resolved or selected that this run
+        did not compute, as it came from load_state, another app of a
+        GemDepsBatch or an earlier request to a GemDepsDaemon. Each one is
+        counted once per run.
+        '''
+        if (counter, key) not in self.counted:
+            self.counted.add((counter, key))
+            self.metrics.increment(counter)
+
+    def prefetch(self, frontier, gem_info=True):
+        '''
+        Fetch packaging status and, if gem_info is true, Rubygems
+        information of a list of gems. Results are only stored in the
+        caches, to be used by process.
+        '''
+        # Gems known from a saved run are looked up only if process needs
+        # them, as their requirement may still change before they are reached
+        pending = [dep for dep in frontier
+                   if (dep.name, tuple(dep.requirement)) not in self.resolved
+                   and dep.name not in self.jsoncontent]
+        self.archive.prefetch([DetailedDependency(dep, self.archive)
+                               .debian_name for dep in pending])
+        if gem_info:
+            needed = [dep for dep in pending if self.needs_gem_info(dep)]
+            self.fetch_gem_infos([dep.name for dep in needed])
+            if self.matching_pool is not None:
+                self.select_versions(needed)
+
+    def needs_gem_info(self, dep):
+        '''
+        Returns if process will need Rubygems information of a gem.
+        '''
+        if "rails-assets" in dep.name or \
+                (dep.name, tuple(dep.requirement)) in self.selected:
+            return False
+        gem = DetailedDependency(dep, self.archive)
+        self.set_status(gem)
+        return not (gem.satisfied and self.ignoresatisfied)
+
+    def load_state(self, path=None, ttl=None):
+        '''
+        Load the graph saved by save_state, so that process only resolves
+        gems that are new or whose requirement changed since then, and the
+        gems below them. Returns if a saved graph was found.
+
+        Saved packaging statuses expire like the entries of a StatusCache,
+        after the seconds given for their suite in ttl, a map updating
+        STATUS_TTL. Expired ones are looked up again.
+        '''
+        from .cache import STATUS_TTL
+        suite_ttl = dict(STATUS_TTL)
+        if ttl:
+            suite_ttl.update(ttl)
+        if path:
+            state_path = os.path.join(path, 'gemdeps_state.json')
+        else:
+            state_path = 'gemdeps_state.json'
+        if not os.path.exists(state_path):
+            return False
+        with open(state_path) as f:
+            state = json.load(f)
+        now = time.time()
+        for name, node in state['nodes'].items():
+            key = (name, tuple(node['requirement']))
+            suite = STATE_SUITES.get(node['suite'], 'wnpp')
+            checked = node.get('checked', 0)
+            if now - checked < suite_ttl.get(suite, 0):
+                self.resolved[key] = dict(
+                    (attribute, node[attribute])
+                    for attribute in STATUS_ATTRIBUTES)
+                self.jsoncontent[name] = {'version': node['version'],
+                                          'suite': node['suite'],
+                                          'link': node['link']}
+                self.checked[name] = checked
+            if node['dependencies'] is not None:
+                self.selected[key] = node['dependencies']
+        return True
+
+    def save_state(self, path=None):
+        '''
+        Save the resolved graph: each gem with its merged requirement,
+        parents, packaging status, the time the status was looked up and
+        the dependencies of its selected version.
+        '''
+        if path:
+            state_path = os.path.join(path, 'gemdeps_state.json')
+        else:
+            state_path = 'gemdeps_state.json'
+        nodes = {}
+        for name, gem in self.dependency_list.items():
+            node = dict((attribute, getattr(gem, attribute))
+                        for attribute in STATUS_ATTRIBUTES)
+            node['requirement'] = gem.requirement
+            node['parent'] = gem.parent
+            node['checked'] = self.checked.get(name, time.time())
+            node['dependencies'] = self.selected.get(
+                (name, tuple(gem.requirement)))
+            nodes[name] = node
+        with open(state_path, 'w') as f:
+            f.write(json.dumps({'nodes': nodes}, indent=4))
+
+    def get_gem_info(self, name):
+        '''
+        Return information about all versions of a gem from Rubygems API.
+        '''
+        if name not in self.gem_info:
+            if self.metadata is not None:
+                with self.metrics.timer('compact_index'):
+                    self.gem_info[name] = self.metadata.get(name)
+            else:
+                self.gem_info[name] = json.loads(self.fetch_gem_info(name))
+        return self.gem_info[name]
+
+    def fetch_gem_info(self, name):
+        '''
+        Return the Rubygems API response for a gem, using the cache if
+        possible. Stale cache entries are revalidated with the server.
+        '''
+        cached = None
+        if self.cache:
+            cached = self.cache.get(name)
+            if cached and self.cache.is_fresh(cached):
+                self.metrics.increment('dependency_cache_hits')
+                return cached.body
+            self.metrics.increment('dependency_cache_misses')
+            if self.cache.offline:
+                raise IOError("%s is not in the cache" % name)
+        return self.revalidate(name, cached)
+
+    def revalidate(self, name, cached=None):
+        '''
+        Fetch the Rubygems API response for a gem, conditionally if cached
+        holds a stale cache entry with validators, and return it.
+        '''
+        headers = {}
+        if cached and cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached and cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+        status, response_headers, body = self.client.get(
+            '%s?gems=%s' % (RUBYGEMS_API, name), headers)
+        if status == 304 and cached:
+            self.metrics.increment('dependency_cache_revalidated')
+            self.cache.touch(name)
+            return cached.body
+        if status != 200:
+            raise IOError("Rubygems returned %s for %s" % (status, name))
+        body = body.decode('utf-8')
+        if self.cache:
+            self.cache.put(name, body, response_headers.get('ETag'),
+                           response_headers.get('Last-Modified'))
+        return body
+
+    def fetch_gem_infos(self, names):
+        '''
+        Fetch Rubygems information of many gems, batch_size gems per
+        request, and store it in gem_info. Fresh cache entries are used
+        directly. Stale ones with an ETag or Last-Modified value are
+        revalidated with a conditional request each, as the server usually
+        answers that they are unchanged, and the others are fetched again.
+        '''
+        if self.metadata is not None:
+            for name in names:
+                self.get_gem_info(name)
+            return
+        pending = []
+        stale = []
+        for name in names:
+            if name in self.gem_info or name in pending:
+                continue
+            if self.cache:
+                cached = self.cache.get(name)
+                if cached and self.cache.is_fresh(cached):
+                    self.metrics.increment('dependency_cache_hits')
+                    self.gem_info[name] = json.loads(cached.body)
                     continue
-                current_gem.debian_status()
-                self.dependency_list[current_gem.name] = current_gem
-                if current_gem.satisfied and self.ignoresatisfied:
-                    print("%s is satisfied in %s" % (current_gem.name,
-                                                     current_gem.suite))
-                else:
-                    gem_dependencies = self.get_dependencies(current_gem)
-                    for dep in gem_dependencies:
-                        dep.parent.append(current_gem.name)
-                        if dep.name not in self.original_list_name:
-                            self.original_list.append(dep)
-                            self.original_list_name.append(dep.name)
-                        else:
-                            existing_position = self.original_list_name.\
-                                index(dep.name)
-                            requirement1 = self.original_list[
-                                existing_position].requirement
-                            requirement2 = dep.requirement
-                            stricter_req = get_stricter(requirement1,
-                                                        requirement2)
-                            if stricter_req != requirement1:
-                                self.original_list[existing_position]\
-                                    .requirement = requirement2
-                counter = counter + 1
-                pass
-            except IndexError:
-                break
+                self.metrics.increment('dependency_cache_misses')
+                if self.cache.offline:
+                    raise IOError("%s is not in the cache" % name)
+                if cached and (cached.etag or cached.last_modified):
+                    stale.append((name, cached))
+                    continue
+            pending.append(name)
+        batches = [pending[start:start + self.batch_size]
+                   for start in range(0, len(pending), self.batch_size)]
+        jobs = [(self.fetch_batch, batch) for batch in batches]
+        jobs.extend((self.revalidate_gem_info, entry) for entry in stale)
+        if self.workers > 1 and len(jobs) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                list(pool.map(lambda job: job[0](job[1]), jobs))
+        else:
+            for function, argument in jobs:
+                function(argument)
+
+    def revalidate_gem_info(self, entry):
+        '''
+        Revalidate a (name, stale cache entry) pair and store the result in
+        gem_info.
+        '''
+        name, cached = entry
+        self.gem_info[name] = json.loads(self.revalidate(name, cached))
+
+    def fetch_batch(self, names):
+        '''
+        Fetch Rubygems information of a list of gems in a single request and
+        split the combined response per gem.
+        '''
+        status, response_headers, body = self.client.get(
+            '%s?gems=%s' % (RUBYGEMS_API, ','.join(names)))
+        if status != 200:
+            raise IOError("Rubygems returned %s for %s" %
+                          (status, ','.join(names)))
+        versions = dict((name, []) for name in names)
+        for gem_version in json.loads(body.decode('utf-8')):
+            if gem_version['name'] in versions:
+                versions[gem_version['name']].append(gem_version)
+        # The ETag is the one of the whole batch, but the gems were all
+        # unchanged at its Last-Modified time
+        for name in names:
+            if self.cache:
+                self.cache.put(name, json.dumps(versions[name]),
+                               last_modified=response_headers.get(
+                                   'Last-Modified'))
+            self.gem_info[name] = versions[name]
 
     def get_dependencies(self, gem):
         '''
         Return dependencies of a gem.
         '''
-        print("Getting Dependencies of %s" % gem.name)
-        api_url = 'https://rubygems.org/api/v1/dependencies.json'
-        parameters = 'gems=%s' % gem.name
-        fetch_url = api_url + '?' + parameters
-        a = urlopen(url=fetch_url)
-        serialized = json.loads(a.read().decode('utf-8'))
-        latest_gem = self.smallest_satisfiable(serialized, gem)
+        log.debug("Getting Dependencies of %s", gem.name)
+        key = (gem.name, tuple(gem.requirement))
+        if key in self.selected:
+            self.count_reused('dependencies_reused', key)
+        else:
+            serialized = self.get_gem_info(gem.name)
+            with self.metrics.timer('select_version'):
+                latest_gem = self.smallest_satisfiable(serialized, gem)
+            self.counted.add(('dependencies_reused', key))
+            self.selected[key] = [(dependency[0], dependency[1].split(','))
+                                  for dependency in latest_gem['dependencies']]
         dependency_list = []
-        for dependency in latest_gem['dependencies']:
-            n = GemfileParser.Dependency()
-            n.name = dependency[0]
-            n.requirement = dependency[1].split(',')
+        for name, requirement in self.selected[key]:
+            n = new_dependency()
+            n.name = name
+            n.requirement = list(requirement)
             dependency_list.append(n)
-            print n.name, n.requirement
+            log.debug("%s %s", n.name, n.requirement)
         return dependency_list
 
+    def select_versions(self, deps):
+        '''
+        Select the smallest version satisfying the requirement of each of a
+        list of gems in matching_pool, and store their dependencies in
+        selected, to be used by get_dependencies.
+        '''
+        jobs = set((dep.name, tuple(dep.requirement)) for dep in deps)
+        jobs = [key for key in jobs if key not in self.selected]
+        if not jobs:
+            return
+        with self.metrics.timer('select_version'):
+            selected = self.matching_pool.select(jobs, self.get_gem_info)
+        self.metrics.increment('pooled_selections', len(jobs))
+        for key, result in selected.items():
+            # get_dependencies reports gems without a satisfying version
+            if result is None:
+                continue
+            version, dependencies = result
+            log.debug("Gem name: %s, Requirement: %s, Selected Version: %s",
+                      key[0], list(key[1]), version)
+            self.counted.add(('dependencies_reused', key))
+            self.selected[key] = [(dependency[0], dependency[1].split(','))
+                                  for dependency in dependencies]
+
     def smallest_satisfiable(self, serialized, gem):
         '''
         Get smallest version of gem that satisfies the requirement.
         '''
-        version_list = {}
-        version_gem_list = []
-        for gem_version in serialized:
-            version_list[gem_version['number']] = gem_version
-            version_gem_list.append(gem_version['number'])
-        least = least_satisfiable_version(gem.requirement, version_gem_list)
-        print("Gem name: %s, Requirement: %s, Selected Version: %s" %
-              (gem.name, gem.requirement, least))
+        index, version_list = self.get_version_index(gem.name, serialized)
+        least = index.least(gem.requirement)
+        if least is None:
+            raise ValueError("No version of %s satisfies %s" %
+                             (gem.name, gem.requirement))
+        log.debug("Gem name: %s, Requirement: %s, Selected Version: %s",
+                  gem.name, gem.requirement, least)
         return version_list[least]
 
+    def get_version_index(self, name, serialized=None):
+        '''
+        Return the VersionIndex of a gem and a map of each version to its
+        entry in the Rubygems information, built once per gem.
+        '''
+        if name not in self.version_index:
+            if serialized is None:
+                serialized = self.get_gem_info(name)
+            version_list = {}
+            for gem_version in serialized:
+                # Prefer the plain Ruby build over platform specific ones
+                if gem_version['number'] not in version_list or \
+                        gem_version.get('platform') == 'ruby':
+                    version_list[gem_version['number']] = gem_version
+            self.version_index[name] = (VersionIndex(version_list),
+                                        version_list)
+        return self.version_index[name]
+
+    def resolve(self, path, prefer='lowest'):
+        '''
+        Generates dependency list based on provided input file, like
+        process, but with a backtracking Resolver that pins a single
+        version of each gem satisfying all requirements on it, instead of
+        the smallest version satisfying the requirements seen so far.
+
+        The pinned versions are kept in pinned. Gems satisfied in Debian
+        are still not expanded if ignoresatisfied is set, but the
+        requirement of each gem is the one merged over the whole resolved
+        graph.
+        '''
+        from .resolver import Resolver
+        self.parse_gemfile(path)
+        resolver = Resolver(self.get_version_index, self.fetch_gem_infos,
+                            prefer)
+        with self.metrics.timer('resolve'):
+            self.pinned = resolver.resolve(
+                [(dep.name, tuple(dep.requirement))
+                 for dep in self.original_list])
+        self.metrics.increment('resolver_backtracks', resolver.backtracks)
+        graph = {}
+        for name, version in self.pinned.items():
+            graph[name] = [(dep_name, list(requirement)) for
+                           dep_name, requirement in
+                           resolver.dependencies(name, version)]
+        self.process_graph(graph)
+
+    def process_lockfile(self, path, gemfile=None):
+        '''
+        Generates dependency list from a Gemfile.lock, without looking up
+        Rubygems information, as the locked specs already list the version
+        and dependencies of each gem.
+
+        The runtime gems of gemfile are walked if it is given, else all
+        gems of the DEPENDENCIES section. The locked versions are kept in
+        pinned, to be written by write_pinned.
+        '''
+        from .lockfile import Lockfile
+        with self.metrics.timer('parse_lockfile'):
+            lockfile = Lockfile(path)
+        if gemfile:
+            self.parse_gemfile(gemfile)
+        else:
+            self.original_list = []
+            for name, requirement in lockfile.dependencies:
+                dep = new_dependency()
+                dep.name = name
+                dep.requirement = requirement
+                dep.parent = [self.appname]
+                self.original_list.append(dep)
+        self.pinned = lockfile.specs
+        self.process_graph(lockfile.graph)
+
+    def process_graph(self, graph):
+        '''
+        Generates dependency list from a known dependency graph, which maps
+        each gem to the (name, requirement) pairs of the dependencies of its
+        version. Only packaging status is looked up.
+
+        The requirement of each gem is merged over all of its dependents in
+        the graph first, so that it does not depend on the order the gems
+        are visited in.
+        '''
+        requirements = {}
+        edges = [(dep.name, dep.requirement) for dep in self.original_list]
+        for dependencies in graph.values():
+            edges.extend(dependencies)
+        for name, requirement in edges:
+            if name not in requirements:
+                requirements[name] = tuple(requirement)
+                continue
+            merged = merge_requirements(requirements[name],
+                                        tuple(requirement))
+            if merged is None:
+                log.warning("Requirements %s and %s on %s conflict, "
+                            "using %s", list(requirements[name]),
+                            requirement, name, requirement)
+                merged = tuple(requirement)
+            requirements[name] = merged
+        for dep in self.original_list:
+            dep.requirement = list(requirements[dep.name])
+        self.graph = graph
+        self.graph_requirements = requirements
+        self.walk(self.graph_dependencies, gem_info=False)
+
+    def graph_dependencies(self, gem):
+        '''
+        Return dependencies of a gem in the graph given to process_graph.
+        '''
+        dependency_list = []
+        for name, requirement in self.graph.get(gem.name, []):
+            n = new_dependency()
+            n.name = name
+            n.requirement = list(self.graph_requirements[name])
+            dependency_list.append(n)
+        return dependency_list
+
+    def write_pinned(self, path=None):
+        '''
+        Write the versions pinned by resolve, or locked in the Gemfile.lock
+        given to process_lockfile, to pinned.json.
+        '''
+        if path:
+            out_path = os.path.join(path, 'pinned.json')
+        else:
+            out_path = 'pinned.json'
+        with open(out_path, 'w') as f:
+            f.write(json.dumps(self.pinned, indent=4, sort_keys=True))
+
     def write_output(self, path=None):
         '''
         Generate output in JSON format to generate statusbar.
@@ -376,11 +900,12 @@ class GemDeps(object):
             out_path = os.path.join(path, 'debian_status.json')
         else:
             out_path = 'debian_status.json'
-        new_list = {}
-        for dep in self.dependency_list:
-            new_list[dep] = self.dependency_list[dep].__dict__
-        with open(out_path, "w") as f:
-            f.write(json.dumps(new_list, indent=4))
+        with self.metrics.timer('write_output'):
+            new_list = {}
+            for dep in self.dependency_list:
+                new_list[dep] = self.dependency_list[dep].to_dict()
+            with open(out_path, "w") as f:
+                f.write(json.dumps(new_list, indent=4))
 
     def generate_dot(self, path=None):
         '''
@@ -391,15 +916,178 @@ class GemDeps(object):
         else:
             out_path = 'graph.dot'
 
-        dotf = open(out_path, 'w')
-        dotf.write('digraph %s\n{\n' % self.appname)
-        for dep in self.dependency_list:
-            name = dep
-            color = self.dependency_list[dep].color
-            block = '"%s"[color=%s];\n' % (name, color)
-            dotf.write(block)
-            for parent in self.dependency_list[dep].parent:
-                dotf.write('"%s"->"%s";\n' %
-                           (parent, self.dependency_list[dep].name))
-        dotf.write("}")
-        dotf.close()
+        with self.metrics.timer('generate_dot'):
+            dotf = open(out_path, 'w')
+            dotf.write('digraph %s\n{\n' % self.appname)
+            for dep in self.dependency_list:
+                name = dep
+                color = self.dependency_list[dep].color
+                block = '"%s"[color=%s];\n' % (name, color)
+                dotf.write(block)
+                for parent in self.dependency_list[dep].parent:
+                    dotf.write('"%s"->"%s";\n' %
+                               (parent, self.dependency_list[dep].name))
+            dotf.write("}")
+            dotf.close()
+
+    def open_streams(self, path=None):
+        '''
+        Start writing output while process runs: each gem is written to
+        debian_status.ndjson as one JSON line, and to graph.dot with its
+        edges, as soon as its packaging status is known. A gem is written
+        again to debian_status.ndjson when another parent of it is found,
+        so the last line of each gem is the complete one.
+        '''
+        if path:
+            ndjson_path = os.path.join(path, 'debian_status.ndjson')
+            dot_path = os.path.join(path, 'graph.dot')
+        else:
+            ndjson_path = 'debian_status.ndjson'
+            dot_path = 'graph.dot'
+        self.status_stream = open(ndjson_path, 'w')
+        self.dot_stream = open(dot_path, 'w')
+        self.dot_stream.write('digraph %s\n{\n' % self.appname)
+        self.dot_stream.flush()
+
+    def close_streams(self):
+        '''
+        Finish the output started by open_streams.
+        '''
+        self.dot_stream.write("}")
+        self.dot_stream.close()
+        self.status_stream.close()
+        self.status_stream = None
+        self.dot_stream = None
+
+    def stream_gem(self, gem):
+        '''
+        Write a gem whose packaging status is known to the open streams.
+        '''
+        if not self.status_stream:
+            return
+        self.status_stream.write(json.dumps(gem.to_dict()) + '\n')
+        self.status_stream.flush()
+        self.dot_stream.write('"%s"[color=%s];\n' % (gem.name, gem.color))
+        for parent in gem.parent:
+            self.dot_stream.write('"%s"->"%s";\n' % (parent, gem.name))
+        self.dot_stream.flush()
+
+    def stream_edge(self, parent, name):
+        '''
+        Write a parent found after its gem was written to the open streams:
+        the gem is written to the NDJSON stream again, with all its parents,
+        and the edge to the dot stream.
+        '''
+        if not self.status_stream:
+            return
+        gem = self.dependency_list[name]
+        self.status_stream.write(json.dumps(gem.to_dict()) + '\n')
+        self.status_stream.flush()
+        self.dot_stream.write('"%s"->"%s";\n' % (parent, name))
+        self.dot_stream.flush()
+
+
+class GemDepsBatch(object):
+    '''
+    Class to generate dependency lists of many Ruby (on Rails) apps at once.
+
+    All apps share the Debian packaging information, the Rubygems
+    information and the versions selected for each requirement, so each
+    gem is looked up once no matter how many apps use it.
+    '''
+
+    def __init__(self, ignoresatisfied=True, workers=1, archive=None,
+                 cache=None, batch_size=50, client=None, metadata=None,
+                 metrics=None, matching_pool=None):
+        '''
+        Initialize necessary attributes. The arguments are passed on to
+        GemDeps.
+        '''
+        self.ignoresatisfied = ignoresatisfied
+        self.workers = workers
+        self.archive, self.client, self.metrics = default_services(
+            workers, archive, client, metrics)
+        self.cache = cache
+        self.batch_size = batch_size
+        self.metadata = metadata
+        self.matching_pool = matching_pool
+        self.gem_info = {}
+        self.version_index = {}
+        self.selected = {}
+        self.resolved = {}
+        self.apps = {}
+
+    def read_manifest(self, path):
+        '''
+        Return (appname, Gemfile path) pairs listed in a manifest file.
+
+        Each line of the manifest has an app name and the path to its
+        Gemfile, or only the path, in which case the name of the directory
+        holding the Gemfile is used. Relative paths are taken from the
+        directory of the manifest. Empty lines and lines starting with #
+        are skipped.
+        '''
+        apps = []
+        base = os.path.dirname(os.path.abspath(path))
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+                gemfile = os.path.join(base, fields[-1])
+                if len(fields) > 1:
+                    appname = fields[0]
+                else:
+                    appname = os.path.basename(os.path.dirname(gemfile))
+                apps.append((appname, gemfile))
+        return apps
+
+    def process(self, apps):
+        '''
+        Generate dependency lists of a list of (appname, Gemfile path) pairs.
+        '''
+        for appname, path in apps:
+            self.process_app(appname, path)
+
+    def process_app(self, appname, path):
+        '''
+        Generate the dependency list of one app and return its GemDeps.
+        '''
+        app = GemDeps(appname, ignoresatisfied=self.ignoresatisfied,
+                      workers=self.workers, archive=self.archive,
+                      cache=self.cache, batch_size=self.batch_size,
+                      client=self.client, metadata=self.metadata,
+                      metrics=self.metrics, matching_pool=self.matching_pool)
+        app.gem_info = self.gem_info
+        app.version_index = self.version_index
+        app.selected = self.selected
+        app.resolved = self.resolved
+        app.process(path)
+        self.apps[appname] = app
+        return app
+
+    def clear(self):
+        '''
+        Forget all information looked up so far, so that it is looked up
+        again for the next apps.
+        '''
+        self.archive.clear()
+        self.gem_info.clear()
+        self.version_index.clear()
+        self.selected.clear()
+        self.resolved.clear()
+        if self.matching_pool is not None:
+            self.matching_pool.clear()
+        self.apps = {}
+
+    def write_output(self, path=None):
+        '''
+        Write debian_status.json and graph.dot of each app into a directory
+        named after the app.
+        '''
+        for appname, app in self.apps.items():
+            out_path = os.path.join(path or '', appname)
+            if not os.path.isdir(out_path):
+                os.makedirs(out_path)
+            app.write_output(out_path)
+            app.generate_dot(out_path)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+import sqlite3
+import threading
+import time
+
+
+class CachedResponse(object):
+    '''
+    Class to hold a cached API response and its validators.
+    '''
+
+    def __init__(self, body, etag, last_modified, fetched):
+        '''
+        Initialize attributes.
+        '''
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = fetched
+
+
+class DependencyCache(object):
+    '''
+    On-disk cache of Rubygems API responses, keyed by gem name and stored in
+    a sqlite database.
+
+    Entries older than ttl seconds are stale and have to be revalidated
+    with the server using their ETag or Last-Modified values. When the
+    total size of the cached responses grows beyond max_size bytes, the
+    least recently used entries are removed. In offline mode, entries are
+    used regardless of their age.
+    '''
+
+    def __init__(self, path, ttl=86400, max_size=64 * 1024 * 1024,
+                 offline=False):
+        '''
+        Initialize attributes and create the database if needed.
+        '''
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'name TEXT PRIMARY KEY, body TEXT, etag TEXT, '
+                'last_modified TEXT, fetched REAL, accessed REAL, '
+                'size INTEGER)')
+
+    def get(self, name):
+        '''
+        Return the cached response for name, or None if there is none.
+        '''
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT body, etag, last_modified, fetched FROM responses '
+                'WHERE name = ?', (name,)).fetchone()
+            if row is None:
+                return None
+            with self.connection:
+                self.connection.execute(
+                    'UPDATE responses SET accessed = ? WHERE name = ?',
+                    (time.time(), name))
+        return CachedResponse(*row)
+
+    def is_fresh(self, response):
+        '''
+        Returns if a cached response can be used without revalidation.
+        '''
+        return self.offline or time.time() - response.fetched < self.ttl
+
+    def put(self, name, body, etag=None, last_modified=None):
+        '''
+        Store a response, evicting old entries if the cache is full.
+        '''
+        now = time.time()
+        with self.lock:
+            with self.connection:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO responses VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?)',
+                    (name, body, etag, last_modified, now, now, len(body)))
+                self.evict()
+
+    def touch(self, name):
+        '''
+        Mark a response as fresh after the server confirmed it is unchanged.
+        '''
+        with self.lock:
+            with self.connection:
+                self.connection.execute(
+                    'UPDATE responses SET fetched = ? WHERE name = ?',
+                    (time.time(), name))
+
+    def evict(self):
+        '''
+        Remove least recently used entries until the cache fits in max_size.
+        '''
+        total = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self.connection.execute(
+            'SELECT name, size FROM responses ORDER BY accessed').fetchall()
+        for name, size in rows:
+            if total <= self.max_size:
+                break
+            self.connection.execute('DELETE FROM responses WHERE name = ?',
+                                    (name,))
+            total = total - size
+
+    def close(self):
+        '''
+        Close the database.
+        '''
+        self.connection.close()
+
+
+STATUS_TTL = {'unstable': 86400,
+              'experimental': 86400,
+              'new': 3600,
+              'wnpp': 3600}
+
+
+class StatusCache(object):
+    '''
+    On-disk cache of Debian packaging information, keyed by package name
+    and suite and stored in a sqlite database that can be shared by several
+    gemdeps processes.
+
+    Each suite expires on its own schedule, given in seconds by ttl, so that
+    the NEW queue and WNPP bugs, which change often, are looked up again
+    sooner than unstable. Packages missing from a suite are cached as an
+    empty string.
+    '''
+
+    def __init__(self, path, ttl=None):
+        '''
+        Initialize attributes and create the database if needed.
+        '''
+        self.path = path
+        self.ttl = dict(STATUS_TTL)
+        if ttl:
+            self.ttl.update(ttl)
+        self.lock = threading.Lock()
+        # Other processes may be writing, wait for them instead of failing
+        self.connection = sqlite3.connect(path, timeout=60,
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS status ('
+                'package TEXT, suite TEXT, value TEXT, fetched REAL, '
+                'PRIMARY KEY (package, suite))')
+
+    def get(self, package, suite):
+        '''
+        Return the cached value for package in suite, or None if there is
+        none or it has expired.
+        '''
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT value, fetched FROM status '
+                'WHERE package = ? AND suite = ?', (package, suite)).fetchone()
+        if row is None or time.time() - row[1] >= self.ttl.get(suite, 0):
+            return None
+        return row[0]
+
+    def put(self, rows):
+        '''
+        Store a list of (package, suite, value) rows in one transaction.
+        '''
+        now = time.time()
+        with self.lock:
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO status VALUES (?, ?, ?, ?)',
+                    [(package, suite, value, now)
+                     for package, suite, value in rows])
+
+    def close(self):
+        '''
+        Close the database.
+        '''
+        self.connection.close()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import tempfile
+import threading
+import time
+
+from . import GemDepsBatch
+
+if os.environ.get('XDG_RUNTIME_DIR'):
+    DEFAULT_SOCKET = os.path.join(os.environ['XDG_RUNTIME_DIR'],
+                                  'gemdeps.sock')
+else:
+    DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(),
+                                  'gemdeps-%d.sock' % os.getuid())
+
+log = logging.getLogger(__name__)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    '''
+    Reads one JSON request per line from a client and writes one JSON
+    response per line back.
+    '''
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.gemdeps.handle(json.loads(
+                    line.decode('utf-8')))
+            except Exception as e:
+                log.exception("Request failed")
+                response = {'status': 'error',
+                            'message': '%s: %s' % (type(e).__name__, e)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class GemDepsDaemon(object):
+    '''
+    Long-running gemdeps service, answering queries on a Unix socket.
+
+    The Debian packaging information, the Rubygems information and the
+    versions selected for each requirement are kept in memory across
+    requests, like GemDepsBatch does across apps, so that apps that were
+    seen before are resolved without any lookup. Everything is forgotten
+    after ttl seconds so that changes in Debian and Rubygems are picked up.
+
+    Requests are JSON objects with a "command":
+
+    * resolve: resolve the Gemfile at "gemfile" for "appname" and return
+      the status of each gem in "gems". If "output_dir" is given,
+      debian_status.json and graph.dot are written there.
+    * status: return the last known status of the gems listed in "gems".
+    * metrics: return the counters and timings of the daemon.
+    * shutdown: stop the daemon.
+
+    Requests are answered one at a time.
+    '''
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, ttl=3600,
+                 ignoresatisfied=True, workers=1, archive=None, cache=None,
+                 batch_size=50, client=None, metadata=None, metrics=None,
+                 matching_pool=None):
+        '''
+        Initialize attributes. The other arguments are passed on to
+        GemDepsBatch.
+        '''
+        self.socket_path = socket_path
+        self.ttl = ttl
+        self.batch = GemDepsBatch(ignoresatisfied=ignoresatisfied,
+                                  workers=workers, archive=archive,
+                                  cache=cache, batch_size=batch_size,
+                                  client=client, metadata=metadata,
+                                  metrics=metrics,
+                                  matching_pool=matching_pool)
+        self.gems = {}
+        self.loaded = time.time()
+        self.server = None
+
+    def expire(self):
+        '''
+        Forget everything looked up if it is older than ttl.
+        '''
+        if time.time() - self.loaded >= self.ttl:
+            log.info("Clearing information older than %s seconds", self.ttl)
+            self.batch.clear()
+            self.gems = {}
+            self.loaded = time.time()
+
+    def handle(self, request):
+        '''
+        Answer a request.
+        '''
+        command = request.get('command')
+        if command == 'resolve':
+            return self.resolve(request)
+        elif command == 'status':
+            return {'status': 'ok',
+                    'gems': dict((name, self.gems.get(name))
+                                 for name in request.get('gems', []))}
+        elif command == 'metrics':
+            return {'status': 'ok',
+                    'metrics': self.batch.metrics.to_dict()}
+        elif command == 'shutdown':
+            # shutdown waits for serve_forever, which is running this request
+            threading.Thread(target=self.server.shutdown).start()
+            return {'status': 'ok'}
+        raise ValueError("Unknown command %s" % command)
+
+    def resolve(self, request):
+        '''
+        Resolve a Gemfile and return the status of its gems.
+        '''
+        self.expire()
+        app = self.batch.process_app(request['appname'], request['gemfile'])
+        # Only the latest graph of each app is needed
+        del self.batch.apps[request['appname']]
+        if request.get('output_dir'):
+            app.write_output(request['output_dir'])
+            app.generate_dot(request['output_dir'])
+        gems = dict((name, gem.to_dict())
+                    for name, gem in app.dependency_list.items())
+        self.gems.update(gems)
+        return {'status': 'ok', 'gems': gems}
+
+    def serve(self):
+        '''
+        Listen on the socket until a shutdown request arrives.
+        '''
+        if os.path.lexists(self.socket_path):
+            check_socket(self.socket_path)
+            if is_running(self.socket_path):
+                raise IOError("A daemon is already listening on %s" %
+                              self.socket_path)
+            os.remove(self.socket_path)
+        # Only the user running the daemon may connect
+        umask = os.umask(0o177)
+        try:
+            self.server = socketserver.UnixStreamServer(self.socket_path,
+                                                        RequestHandler)
+        finally:
+            os.umask(umask)
+        self.server.gemdeps = self
+        log.info("Listening on %s", self.socket_path)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.remove(self.socket_path)
+
+
+def check_socket(socket_path):
+    '''
+    Raise IOError unless socket_path is a socket owned by the current user,
+    so that a socket planted by another user is never trusted.
+    '''
+    info = os.lstat(socket_path)
+    if not stat.S_ISSOCK(info.st_mode):
+        raise IOError("%s is not a socket" % socket_path)
+    if info.st_uid != os.getuid():
+        raise IOError("%s is owned by another user" % socket_path)
+
+
+def is_running(socket_path=DEFAULT_SOCKET):
+    '''
+    Returns if a daemon of the current user is listening on socket_path.
+    '''
+    try:
+        check_socket(socket_path)
+    except OSError as e:
+        if os.path.lexists(socket_path):
+            log.warning("Not using the daemon: %s", e)
+        return False
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except socket.error:
+        return False
+    finally:
+        client.close()
+    return True
+
+
+def query(request, socket_path=DEFAULT_SOCKET):
+    '''
+    Send a request to the daemon listening on socket_path and return its
+    response. IOError is raised if the request failed.
+    '''
+    check_socket(socket_path)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with client.makefile('rb') as f:
+            line = f.readline()
+    finally:
+        client.close()
+    if not line:
+        raise IOError("The daemon on %s closed the connection" % socket_path)
+    response = json.loads(line.decode('utf-8'))
+    if response.get('status') != 'ok':
+        raise IOError(response.get('message'))
+    return response
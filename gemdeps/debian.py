@@ -0,0 +1,518 @@
+#!/usr/bin/env python
+
+import asyncio
+import gzip
+import io
+import itertools
+import lzma
+import mmap
+import os
+import random
+import re
+import signal
+import time
+
+from .metrics import Metrics
+from .util import (index_is_current, index_sources, save_index_sources,
+                   search_index)
+
+SUITES = ['unstable', 'experimental', 'new']
+
+SUITE_ALIASES = {'sid': 'unstable',
+                 'rc-buggy': 'experimental'}
+
+WNPP_URL = 'https://qa.debian.org/data/bts/wnpp_rm'
+
+
+class CommandRunner(object):
+    '''
+    Runs commands like rmadison and wnpp-check as asynchronous subprocesses.
+
+    At most concurrency commands run at the same time, each one is killed
+    together with the processes it started after timeout seconds, and
+    failed attempts (timeouts, or curl errors in the output) are retried up
+    to retries times, waiting an exponentially growing, randomly jittered
+    delay in between. Commands that still fail
+    are recorded in failures and reported with IOError instead of being
+    retried forever.
+
+    The duration of each call, and the number of calls, retries and failures
+    of each tool, are recorded in metrics.
+    '''
+
+    def __init__(self, concurrency=4, timeout=120, retries=4, backoff=1.0,
+                 metrics=None):
+        '''
+        Initialize attributes.
+        '''
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.failures = []
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+
+    async def _attempt(self, command, semaphore):
+        '''
+        Run a command once. Returns its output and an error message, which
+        is None if the command worked.
+        '''
+        async with semaphore:
+            tool = os.path.basename(command[0]).replace('-', '_')
+            self.metrics.increment(tool + '_calls')
+            with self.metrics.timer(tool):
+                # A session of its own, so that the curl started by the
+                # command can be killed with it
+                process = await asyncio.create_subprocess_exec(
+                    *command, stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE, start_new_session=True)
+                try:
+                    output, error = await asyncio.wait_for(
+                        process.communicate(), self.timeout)
+                except asyncio.TimeoutError:
+                    try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                    await process.wait()
+                    return '', 'timed out after %s seconds' % self.timeout
+        output = output.decode('utf-8', 'replace')
+        error = error.decode('utf-8', 'replace')
+        if "curl:" in output or "curl:" in error:
+            return output, (output + error).strip()
+        return output, None
+
+    async def _run(self, command, semaphore):
+        '''
+        Run a command, retrying it with backoff if it fails.
+        '''
+        tool = os.path.basename(command[0]).replace('-', '_')
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.metrics.increment(tool + '_retries')
+                delay = self.backoff * 2 ** (attempt - 1)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            try:
+                output, error = await self._attempt(command, semaphore)
+            except OSError as e:
+                # The tool is missing or can not be run, retrying won't help
+                error = str(e)
+                break
+            if error is None:
+                return output
+        self.failures.append((' '.join(command), error))
+        self.metrics.increment(tool + '_failures')
+        raise IOError("%s failed: %s" % (' '.join(command), error))
+
+    async def _run_many(self, commands):
+        '''
+        Run a list of commands concurrently.
+        '''
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(
+            *[self._run(command, semaphore) for command in commands],
+            return_exceptions=True)
+        return results
+
+    def run_many(self, commands):
+        '''
+        Run a list of commands, each a list of arguments, and return their
+        outputs in the same order. IOError is raised if any of them failed.
+        '''
+        if not commands:
+            return []
+        # asyncio.run sets the loop as current, which the child watcher of
+        # Python 3.7 needs to see the subprocesses exit
+        results = asyncio.run(self._run_many(commands))
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def run(self, command):
+        '''
+        Run a single command and return its output.
+        '''
+        return self.run_many([command])[0]
+
+
+def parse_wnpp_check(output):
+    '''
+    Returns the (type, bug number) of a WNPP bug reported by wnpp-check, as
+    in "(ITP - #123456) https://bugs.debian.org/123456 ruby-foo", or None.
+    '''
+    match = re.search(r'\((\w+) - #(\d+)\)', output)
+    if match is None:
+        return None
+    return match.group(1), match.group(2)
+
+
+class WnppIndex(object):
+    '''
+    Open WNPP bugs, like ITP and RFP, of all packages, read at once from a
+    list in the format of WNPP_URL, which wnpp-check also uses: lines of
+    "package: TYPE bug-number ...". Lines in any other format are skipped.
+
+    If url is given, the list is downloaded to path when path is missing
+    or older than ttl seconds. Otherwise path is only read.
+    '''
+
+    def __init__(self, path, url=None, ttl=86400, timeout=60):
+        '''
+        Initialize attributes and load the list.
+        '''
+        self.path = path
+        self.url = url
+        self.ttl = ttl
+        self.timeout = timeout
+        self.bugs = {}
+        self.load()
+
+    def load(self):
+        '''
+        Read the list, downloading it first if needed.
+        '''
+        if self.url and (not os.path.exists(self.path) or
+                         time.time() - os.path.getmtime(self.path) >=
+                         self.ttl):
+            self.download()
+        bugs = {}
+        with io.open(self.path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                match = re.match(r'(\S+?):?\s+([A-Z]+)\s+#?(\d+)', line)
+                if match is None:
+                    continue
+                package, bug_type, number = match.groups()
+                # An ITP is more useful to report than a request
+                if package not in bugs or bug_type == 'ITP':
+                    bugs[package] = (bug_type, number)
+        self.bugs = bugs
+
+    def download(self):
+        '''
+        Download the list from url to path.
+        '''
+        from urllib.request import urlopen
+        tmp_path = self.path + '.tmp'
+        response = urlopen(self.url, timeout=self.timeout)
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(response.read())
+        finally:
+            response.close()
+        os.rename(tmp_path, self.path)
+
+    def get(self, package):
+        '''
+        Return the (type, bug number) of the WNPP bug of package, or None.
+        '''
+        return self.bugs.get(package)
+
+
+class MadisonArchive(object):
+    '''
+    Packaging information of Debian packages, fetched using rmadison and
+    wnpp-check.
+
+    rmadison is called for many packages and all suites at once and the
+    results are kept in a map, so that each package is queried only once.
+    If wnpp_index is a WnppIndex, WNPP bugs are taken from it instead of
+    calling wnpp-check for each unpackaged package.
+    '''
+
+    def __init__(self, batch_size=100, runner=None, wnpp_index=None):
+        '''
+        Initialize attributes. runner is the CommandRunner used to call the
+        tools.
+        '''
+        self.batch_size = batch_size
+        if runner is None:
+            runner = CommandRunner()
+        self.runner = runner
+        self.wnpp_index = wnpp_index
+        self.versions = {}
+        self.wnpp = {}
+
+    def prefetch(self, packages):
+        '''
+        Fetch versions of a list of packages in all suites, and the WNPP
+        bugs of those that are in none of them. The batches of packages are
+        looked up concurrently.
+        '''
+        pending = sorted(set(x for x in packages if x not in self.versions))
+        batches = [pending[start:start + self.batch_size]
+                   for start in range(0, len(pending), self.batch_size)]
+        outputs = self.runner.run_many(
+            [['rmadison', '-s', ','.join(SUITES), '-a', 'amd64,all'] + batch
+             for batch in batches])
+        for batch, output in zip(batches, outputs):
+            versions = dict((package, {}) for package in batch)
+            for line in output.splitlines():
+                fields = [field.strip() for field in line.split('|')]
+                if len(fields) < 3 or fields[0] not in versions:
+                    continue
+                suite = SUITE_ALIASES.get(fields[2], fields[2])
+                # Only the first version listed for a suite is used
+                versions[fields[0]].setdefault(suite, fields[1])
+            self.versions.update(versions)
+        if self.wnpp_index is not None:
+            return
+        unpackaged = [package for package in pending
+                      if not self.versions[package]
+                      and package not in self.wnpp]
+        outputs = self.runner.run_many([['wnpp-check', package]
+                                        for package in unpackaged])
+        self.wnpp.update((package, parse_wnpp_check(output))
+                         for package, output in zip(unpackaged, outputs))
+
+    def get_version(self, package, suite):
+        '''
+        Return version of package in suite, or None if it is not there.
+        '''
+        if package not in self.versions:
+            self.prefetch([package])
+        return self.versions[package].get(suite)
+
+    def get_wnpp(self, package):
+        '''
+        Return the (type, bug number) of the WNPP bug of package, or None.
+        '''
+        if self.wnpp_index is not None:
+            return self.wnpp_index.get(package)
+        if package not in self.wnpp:
+            self.wnpp[package] = parse_wnpp_check(
+                self.runner.run(['wnpp-check', package]))
+        return self.wnpp[package]
+
+    def clear(self):
+        '''
+        Forget the information fetched so far, so that it is fetched again.
+        '''
+        self.versions = {}
+        self.wnpp = {}
+        if self.wnpp_index is not None:
+            self.wnpp_index.load()
+
+
+def open_index_file(path):
+    '''
+    Open a Sources or Packages file, decompressing it if needed.
+    '''
+    if path.endswith('.xz'):
+        return lzma.open(path, 'rt', encoding='utf-8', errors='replace')
+    elif path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    return io.open(path, encoding='utf-8', errors='replace')
+
+
+def read_index_file(path):
+    '''
+    Yield (name, version) pairs from a Sources or Packages file, one stanza
+    at a time. Binary packages are also listed under their source name.
+    '''
+    fields = {}
+    with open_index_file(path) as f:
+        for line in itertools.chain(f, ['\n']):
+            if line.strip() == '':
+                if 'Package' in fields and 'Version' in fields:
+                    yield fields['Package'], fields['Version']
+                    if 'Source' in fields:
+                        source = fields['Source'].split()
+                        if len(source) > 1:
+                            yield source[0], source[1].strip('()')
+                        else:
+                            yield source[0], fields['Version']
+                fields = {}
+            elif line[0] not in ' \t' and ':' in line:
+                key, value = line.split(':', 1)
+                if key in ('Package', 'Version', 'Source'):
+                    fields[key] = value.strip()
+
+
+class LocalArchive(object):
+    '''
+    Packaging information of Debian packages, read from local copies of
+    Sources or Packages files, for use without network access.
+
+    The files are parsed into an index of lines "name<TAB>suite<TAB>version"
+    sorted by name. If index_path is given, the index is saved there and
+    later runs memory map it instead of parsing the files again, as long as
+    the same files, of the same size and modification time, are given. WNPP
+    bugs are taken from wnpp_index, a WnppIndex, if it is given.
+    '''
+
+    def __init__(self, files, index_path=None, wnpp_index=None):
+        '''
+        Initialize attributes. files is a list of (suite, path) pairs.
+        '''
+        self.files = [(SUITE_ALIASES.get(suite, suite), path)
+                      for suite, path in files]
+        self.index_path = index_path
+        self.wnpp_index = wnpp_index
+        self.versions = {}
+        self.index = None
+        self.load()
+
+    def load(self):
+        '''
+        Load the index, building it from the files if it is missing or was
+        built from other files.
+        '''
+        if self.index_path:
+            sources = index_sources(self.files)
+            if index_is_current(self.index_path, sources):
+                self.open_index()
+                return
+        entries = {}
+        for suite, path in self.files:
+            for name, version in read_index_file(path):
+                entries.setdefault((name, suite), version)
+        if not self.index_path:
+            for (name, suite), version in entries.items():
+                self.versions.setdefault(name, {})[suite] = version
+            return
+        tmp_path = self.index_path + '.tmp'
+        with io.open(tmp_path, 'w', encoding='utf-8') as f:
+            for (name, suite), version in sorted(entries.items()):
+                f.write(u'%s\t%s\t%s\n' % (name, suite, version))
+        os.rename(tmp_path, self.index_path)
+        save_index_sources(self.index_path, sources)
+        self.open_index()
+
+    def open_index(self):
+        '''
+        Memory map the saved index.
+        '''
+        with open(self.index_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def search_index(self, package):
+        '''
+        Return the versions of package in each suite, found by a binary
+        search over the lines of the saved index.
+        '''
+        versions = {}
+        if self.index is not None:
+            for name, suite, version in search_index(self.index, package):
+                versions[suite] = version
+        return versions
+
+    def prefetch(self, packages):
+        '''
+        Nothing to fetch, all information is local.
+        '''
+        pass
+
+    def get_version(self, package, suite):
+        '''
+        Return version of package in suite, or None if it is not there.
+        '''
+        if package not in self.versions:
+            self.versions[package] = self.search_index(package)
+        return self.versions[package].get(suite)
+
+    def get_wnpp(self, package):
+        '''
+        Return the (type, bug number) of the WNPP bug of package from the
+        WnppIndex, or None. Without one, WNPP information is not available
+        offline.
+        '''
+        if self.wnpp_index is None:
+            return None
+        return self.wnpp_index.get(package)
+
+    def clear(self):
+        '''
+        Forget the information read so far, and read the files again if
+        they changed.
+        '''
+        self.versions = {}
+        self.index = None
+        self.load()
+        if self.wnpp_index is not None:
+            self.wnpp_index.load()
+
+
+class CachedArchive(object):
+    '''
+    Packaging information of Debian packages from another archive, kept in
+    a StatusCache so that it is shared across runs. Every lookup of a
+    package in a suite, or of its WNPP bug, is counted in metrics as a cache
+    hit, or as a miss if the entry had to be fetched, by prefetch or by the
+    lookup itself.
+    '''
+
+    def __init__(self, archive, cache, metrics=None):
+        '''
+        Initialize attributes.
+        '''
+        self.archive = archive
+        self.cache = cache
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.fetched = set()
+
+    def count(self, package, key):
+        '''
+        Count a lookup of an entry of the cache as a miss if it was fetched
+        since it was last looked up, or as a hit.
+        '''
+        if (package, key) in self.fetched:
+            self.fetched.discard((package, key))
+            self.metrics.increment('status_cache_misses')
+        else:
+            self.metrics.increment('status_cache_hits')
+
+    def prefetch(self, packages):
+        '''
+        Fetch versions of the packages that are missing or expired in the
+        cache for any suite.
+        '''
+        stale = sorted(set(x for x in packages
+                           if any(self.cache.get(x, suite) is None
+                                  for suite in SUITES)))
+        if not stale:
+            return
+        self.archive.prefetch(stale)
+        self.cache.put([(package, suite,
+                         self.archive.get_version(package, suite) or '')
+                        for package in stale for suite in SUITES])
+        self.fetched.update((package, suite)
+                            for package in stale for suite in SUITES)
+
+    def get_version(self, package, suite):
+        '''
+        Return version of package in suite, or None if it is not there.
+        '''
+        version = self.cache.get(package, suite)
+        if version is None:
+            version = self.archive.get_version(package, suite) or ''
+            self.cache.put([(package, suite, version)])
+            self.fetched.add((package, suite))
+        self.count(package, suite)
+        return version or None
+
+    def get_wnpp(self, package):
+        '''
+        Return the (type, bug number) of the WNPP bug of package, or None.
+        Bugs are cached as "TYPE NUMBER", and their absence as an empty
+        string.
+        '''
+        value = self.cache.get(package, 'wnpp')
+        if value is None:
+            value = ' '.join(self.archive.get_wnpp(package) or ())
+            self.cache.put([(package, 'wnpp', value)])
+            self.fetched.add((package, 'wnpp'))
+        self.count(package, 'wnpp')
+        return tuple(value.split()) or None
+
+    def clear(self):
+        '''
+        Forget the information held by the other archive. Entries of the
+        cache expire on their own.
+        '''
+        self.archive.clear()
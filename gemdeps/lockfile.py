@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+import re
+
+# "    name (version)" in specs, "      name (requirement, ...)" below it and
+# "  name (requirement, ...)!" in DEPENDENCIES
+ENTRY = re.compile(r'^( *)([^ (!]+)(?: \(([^)]*)\))?!?$')
+
+
+class Lockfile(object):
+    '''
+    The gems of a Gemfile.lock written by Bundler.
+
+    specs maps each locked gem to its version, and graph maps it to the
+    (name, requirement) pairs of its dependencies, from the specs of the
+    GEM, GIT and PATH sections. dependencies lists the (name, requirement)
+    pairs of the DEPENDENCIES section, the gems of the Gemfile.
+    '''
+
+    def __init__(self, path):
+        '''
+        Initialize attributes and parse the file at path.
+        '''
+        self.path = path
+        self.specs = {}
+        self.graph = {}
+        self.dependencies = []
+        self.parse()
+
+    def parse(self):
+        '''
+        Read the file line by line. ValueError is raised if a line of a
+        specs or DEPENDENCIES section can not be parsed.
+        '''
+        section = None
+        in_specs = False
+        current = None
+        platforms = set()
+        with open(self.path) as f:
+            for number, line in enumerate(f, 1):
+                line = line.rstrip()
+                if not line:
+                    continue
+                if not line.startswith(' '):
+                    section = line
+                    in_specs = False
+                    continue
+                if section in ('GEM', 'GIT', 'PATH') and \
+                        line.strip() == 'specs:':
+                    in_specs = True
+                    continue
+                if not (in_specs or section == 'DEPENDENCIES'):
+                    continue
+                match = ENTRY.match(line)
+                if match is None or (section != 'DEPENDENCIES' and
+                                     len(match.group(1)) == 4 and
+                                     not match.group(3)):
+                    raise ValueError("%s:%d: Can not parse %r" %
+                                     (self.path, number, line.strip()))
+                indent, name, details = match.groups()
+                if section == 'DEPENDENCIES':
+                    self.dependencies.append(
+                        (name, self.split_requirement(details, [])))
+                elif len(indent) == 4:
+                    current = None
+                    # Gems built for several platforms are listed once per
+                    # platform, as version-platform. The plain ruby one is
+                    # kept if there is one, else the first one.
+                    version, dash, platform = details.partition('-')
+                    if name not in self.specs or \
+                            (name in platforms and not platform):
+                        self.specs[name] = version
+                        self.graph[name] = []
+                        current = name
+                        if platform:
+                            platforms.add(name)
+                        else:
+                            platforms.discard(name)
+                elif len(indent) == 6 and current is not None:
+                    self.graph[current].append(
+                        (name, self.split_requirement(details, ['>= 0'])))
+
+    @staticmethod
+    def split_requirement(details, default):
+        '''
+        Returns the requirement list of the text between parentheses, or
+        default if there is none.
+        '''
+        if not details:
+            return list(default)
+        return [x.strip() for x in details.split(',')]
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+import pickle
+from functools import lru_cache
+
+from .util import VersionIndex
+
+
+def compact_payload(serialized):
+    '''
+    Returns the Rubygems information of a gem as pickled (version,
+    dependencies) pairs, keeping only what version selection needs. The
+    plain Ruby build of a version is preferred over platform specific ones,
+    as in GemDeps.get_version_index.
+    '''
+    version_list = {}
+    for gem_version in serialized:
+        if gem_version['number'] not in version_list or \
+                gem_version.get('platform') == 'ruby':
+            version_list[gem_version['number']] = tuple(
+                tuple(dependency) for dependency
+                in gem_version['dependencies'])
+    return pickle.dumps(tuple(version_list.items()),
+                        pickle.HIGHEST_PROTOCOL)
+
+
+@lru_cache(maxsize=256)
+def load_payload(payload):
+    '''
+    Returns the VersionIndex and version map of a compact payload. Each
+    worker process keeps the latest ones, as a gem is often selected for
+    several requirements.
+    '''
+    version_list = dict(pickle.loads(payload))
+    return VersionIndex(version_list), version_list
+
+
+def select_least(payload, requirements):
+    '''
+    Returns (version, dependencies) of the smallest version satisfying each
+    of a list of requirements, or None for a requirement that no version
+    satisfies. Run in the worker processes.
+    '''
+    index, version_list = load_payload(payload)
+    selected = []
+    for requirement in requirements:
+        least = index.least(requirement)
+        if least is None:
+            selected.append(None)
+        else:
+            selected.append((least, version_list[least]))
+    return selected
+
+
+class MatchingPool(object):
+    '''
+    Selects versions in a pool of worker processes, so that matching the
+    requirements of many gems with long version histories is spread over
+    several cores instead of running under the GIL.
+
+    The information of each gem is sent in the compact form of
+    compact_payload, built once per gem, and all requirements on a gem are
+    sent in a single job.
+    '''
+
+    def __init__(self, processes=None):
+        '''
+        Initialize attributes. processes defaults to the number of CPUs.
+        The worker processes are started by the first select.
+        '''
+        self.processes = processes
+        self.executor = None
+        self.payloads = {}
+
+    def select(self, jobs, get_gem_info):
+        '''
+        Returns a map of each (name, requirement tuple) pair in jobs to
+        (version, dependencies) of the smallest version satisfying it, or
+        None if no version does. get_gem_info(name) returns the Rubygems
+        information of a gem whose payload is not built yet.
+        '''
+        requirements = {}
+        for name, requirement in jobs:
+            requirements.setdefault(name, []).append(requirement)
+        for name in requirements:
+            if name not in self.payloads:
+                self.payloads[name] = compact_payload(get_gem_info(name))
+        if self.executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            self.executor = ProcessPoolExecutor(self.processes)
+        names = list(requirements)
+        results = self.executor.map(
+            select_least, [self.payloads[name] for name in names],
+            [requirements[name] for name in names])
+        selected = {}
+        for name, result in zip(names, results):
+            for requirement, version in zip(requirements[name], result):
+                selected[(name, requirement)] = version
+        return selected
+
+    def clear(self):
+        '''
+        Forget the payloads built so far, so that they are built again from
+        new Rubygems information.
+        '''
+        self.payloads = {}
+
+    def close(self):
+        '''
+        Stop the worker processes.
+        '''
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+import contextlib
+import json
+import re
+import threading
+import time
+
+
+class Metrics(object):
+    '''
+    Timings of the phases of a run and counters of events like cache hits,
+    retries and bytes fetched.
+
+    The same Metrics can be shared by GemDeps, the RubygemsClient and the
+    CommandRunner of a run, so that everything ends up in one report, which
+    can be written as JSON or in the Prometheus text format.
+    '''
+
+    def __init__(self):
+        '''
+        Initialize attributes.
+        '''
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def increment(self, name, amount=1):
+        '''
+        Add amount to a counter.
+        '''
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, phase, seconds):
+        '''
+        Add a duration of a phase. The number of times, total and longest
+        duration of each phase are kept.
+        '''
+        with self.lock:
+            timing = self.timings.setdefault(
+                phase, {'count': 0, 'seconds': 0.0, 'max': 0.0})
+            timing['count'] = timing['count'] + 1
+            timing['seconds'] = timing['seconds'] + seconds
+            timing['max'] = max(timing['max'], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        '''
+        Record the duration of a with block as phase.
+        '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(phase, time.time() - start)
+
+    def to_dict(self):
+        '''
+        Returns the counters and timings as a dict.
+        '''
+        with self.lock:
+            return {'counters': dict(self.counters),
+                    'timings': dict((phase, dict(timing)) for phase, timing
+                                    in self.timings.items())}
+
+    def to_prometheus(self):
+        '''
+        Returns the counters and timings in the Prometheus text format.
+        Each counter becomes gemdeps_<name>_total and the timings a summary
+        gemdeps_phase_seconds labelled by phase.
+        '''
+        report = self.to_dict()
+        lines = []
+        for name, value in sorted(report['counters'].items()):
+            metric = 'gemdeps_%s_total' % re.sub(r'[^a-zA-Z0-9_]', '_', name)
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s %s' % (metric, value))
+        if report['timings']:
+            lines.append('# TYPE gemdeps_phase_seconds summary')
+        for phase, timing in sorted(report['timings'].items()):
+            lines.append('gemdeps_phase_seconds_count{phase="%s"} %d' %
+                         (phase, timing['count']))
+            lines.append('gemdeps_phase_seconds_sum{phase="%s"} %f' %
+                         (phase, timing['seconds']))
+        if report['timings']:
+            lines.append('# TYPE gemdeps_phase_seconds_max gauge')
+        for phase, timing in sorted(report['timings'].items()):
+            lines.append('gemdeps_phase_seconds_max{phase="%s"} %f' %
+                         (phase, timing['max']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, format='json'):
+        '''
+        Write the report to path, as JSON or, if format is prometheus, in
+        the Prometheus text format.
+        '''
+        if format == 'prometheus':
+            output = self.to_prometheus()
+        else:
+            output = json.dumps(self.to_dict(), indent=4, sort_keys=True)
+        with open(path, 'w') as f:
+            f.write(output)
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+
+import heapq
+import itertools
+import logging
+
+from .util import compile_requirement, merge_requirements
+
+log = logging.getLogger(__name__)
+
+# Why a pinned gem takes part in a conflict: only through the requirements
+# its version sets on other gems, or through the version itself
+REQUIREMENTS = 0
+VERSION = 1
+
+
+def add_culprits(conflicts, culprits):
+    '''
+    Add a map of gems responsible for a conflict to another one, keeping
+    the strongest reason of each gem.
+    '''
+    for name, reason in culprits.items():
+        conflicts[name] = max(conflicts.get(name, REQUIREMENTS), reason)
+
+
+class Frame(object):
+    '''
+    A decision of the Resolver: the gem being pinned, its candidate versions
+    and the gems whose versions caused its candidates to fail.
+    '''
+
+    def __init__(self, name, candidates, sources):
+        '''
+        Initialize attributes.
+        '''
+        self.name = name
+        self.candidates = candidates
+        self.position = 0
+        self.conflicts = dict.fromkeys(sources, REQUIREMENTS)
+        self.undo = []
+
+
+class Resolver(object):
+    '''
+    Backtracking resolver that pins one version of every gem needed by a
+    Gemfile, so that all requirements on each gem are satisfied at once.
+
+    Gems are pinned one at a time, the one with the fewest candidate
+    versions first. When a gem has no candidate left, the search jumps
+    back to the latest pinned gem that constrained it, instead of the
+    latest pinned gem, and the conflict is learned as a nogood, so that it
+    is never tried again. A gem that only caused the conflict through the
+    requirements of its version is recorded with those requirements, so
+    that the nogood also rules out its other versions requiring the same.
+
+    get_versions(name) returns the VersionIndex of a gem and a map of each
+    version to its entry in the Rubygems API. prefetch(names), if given, is
+    called with all gems that became needed, so that their information can
+    be fetched in batches. Versions are tried smallest first, like the
+    greedy walk of GemDeps.process, or largest first, like Bundler, if
+    prefer is 'highest'.
+    '''
+
+    def __init__(self, get_versions, prefetch=None, prefer='lowest'):
+        '''
+        Initialize attributes.
+        '''
+        self.get_versions = get_versions
+        self.prefetch = prefetch
+        self.prefer = prefer
+        self.fetched = set()
+        self.roots = {}
+        self.constraints = {}
+        self.sources = {}
+        self.pinned = {}
+        self.nogoods = {}
+        self.candidate_cache = {}
+        self.signatures = {}
+        self.queue = []
+        self.changed = []
+        self.counter = itertools.count()
+        self.backtracks = 0
+
+    def dependencies(self, name, version):
+        '''
+        Returns the (name, requirement tuple) dependencies of a version.
+        '''
+        index, version_list = self.get_versions(name)
+        return [(dependency[0],
+                 tuple(x.strip() for x in dependency[1].split(',')))
+                for dependency in version_list[version]['dependencies']
+                if "rails-assets" not in dependency[0]]
+
+    def signature(self, name, version):
+        '''
+        Returns the dependencies of a version as a hashable tuple, the same
+        for all versions of a gem requiring the same.
+        '''
+        key = (name, version)
+        if key not in self.signatures:
+            self.signatures[key] = tuple(sorted(
+                self.dependencies(name, version)))
+        return self.signatures[key]
+
+    def satisfies(self, name, version):
+        '''
+        Returns if version satisfies the requirement on a gem.
+        '''
+        index, version_list = self.get_versions(name)
+        compiled = compile_requirement(self.constraints[name])
+        return index.matches(compiled, index.versions.index(version))
+
+    def candidates(self, name, constraint=None):
+        '''
+        Returns the versions of a gem allowed by its requirement, or by
+        constraint if given, in the order they are tried. They are computed
+        once per requirement.
+        '''
+        if constraint is None:
+            constraint = self.constraints[name]
+        key = (name, constraint)
+        if key not in self.candidate_cache:
+            index, version_list = self.get_versions(name)
+            versions = index.satisfying(constraint)
+            if self.prefer == 'highest':
+                versions.reverse()
+            self.candidate_cache[key] = versions
+        return self.candidate_cache[key]
+
+    def needed(self, name):
+        '''
+        Returns if a gem is required by the Gemfile or a pinned gem but not
+        pinned yet.
+        '''
+        return name not in self.pinned and \
+            (name in self.roots or bool(self.sources[name]))
+
+    def explain(self, name):
+        '''
+        Returns the gems whose requirements on a gem conflict, with the
+        Gemfile and with its pinned version if any, as a map like the
+        conflicts of a Frame. Requirements that are not needed for the
+        conflict are dropped one by one, so that the gems that are not
+        responsible are not blamed.
+        '''
+        def conflicting(requirements):
+            merged = self.roots.get(name, ())
+            for source, requirement in requirements:
+                merged = merge_requirements(merged, requirement)
+                if merged is None:
+                    return True
+            if name in self.pinned:
+                return self.pinned[name] not in self.candidates(name, merged)
+            return not self.candidates(name, merged)
+
+        requirements = list(self.sources[name])
+        for item in list(requirements):
+            trial = [other for other in requirements if other is not item]
+            if conflicting(trial):
+                requirements = trial
+        culprits = dict((source, REQUIREMENTS)
+                        for source, requirement in requirements)
+        if name in self.pinned:
+            culprits[name] = VERSION
+        return culprits
+
+    def select(self):
+        '''
+        Returns the needed gem that is not pinned yet and has the fewest
+        candidates, or None if all are pinned.
+
+        Needed gems are kept in a heap by their number of candidates. Gems
+        whose requirement changed are pushed again, and outdated entries
+        are skipped when they come up.
+        '''
+        changed = [name for name in dict.fromkeys(self.changed)
+                   if self.needed(name)]
+        self.changed = []
+        unfetched = [name for name in changed if name not in self.fetched]
+        if unfetched and self.prefetch is not None:
+            self.prefetch(unfetched)
+        self.fetched.update(unfetched)
+        for name in changed:
+            heapq.heappush(self.queue, (len(self.candidates(name)),
+                                        next(self.counter), name,
+                                        self.constraints[name]))
+        while self.queue:
+            count, order, name, constraint = heapq.heappop(self.queue)
+            if self.needed(name) and self.constraints[name] == constraint:
+                return name
+        return None
+
+    def constrain(self, name, requirement, source, undo):
+        '''
+        Add requirement, set by the pinned version of source, to a gem.
+        Returns the gems responsible if no version can satisfy it anymore.
+        '''
+        if name not in self.constraints:
+            self.constraints[name] = ()
+            self.sources[name] = []
+        undo.append((name, self.constraints[name]))
+        self.sources[name].append((source, requirement))
+        self.changed.append(name)
+        merged = merge_requirements(self.constraints[name], requirement)
+        if merged is None:
+            self.constraints[name] = self.constraints[name] + requirement
+            return self.explain(name)
+        self.constraints[name] = merged
+        if name in self.pinned:
+            if not self.satisfies(name, self.pinned[name]):
+                return self.explain(name)
+        elif not self.candidates(name):
+            return self.explain(name)
+        return None
+
+    def nogood_key(self, name, reason, version):
+        '''
+        Returns what a nogood records of a pinned gem.
+        '''
+        if reason == VERSION:
+            return version
+        return self.signature(name, version)
+
+    def check_nogoods(self, name, version):
+        '''
+        Returns the gems of a learned nogood that pinning name to version
+        would complete, or None.
+        '''
+        nogoods = itertools.chain(
+            self.nogoods.get((name, VERSION, version), ()),
+            self.nogoods.get((name, REQUIREMENTS,
+                              self.signature(name, version)), ()))
+        for nogood in nogoods:
+            for other, reason, key in nogood:
+                if other == name:
+                    other_version = version
+                elif other in self.pinned:
+                    other_version = self.pinned[other]
+                else:
+                    break
+                if self.nogood_key(other, reason, other_version) != key:
+                    break
+            else:
+                return dict((other, reason)
+                            for other, reason, key in nogood)
+        return None
+
+    def pin(self, frame, version):
+        '''
+        Pin the gem of frame to version and add the requirements of that
+        version. Returns the gems responsible for a conflict, after undoing
+        the pin, or None.
+        '''
+        culprits = self.check_nogoods(frame.name, version)
+        if culprits is not None:
+            return culprits
+        self.pinned[frame.name] = version
+        for name, requirement in self.dependencies(frame.name, version):
+            culprits = self.constrain(name, requirement, frame.name,
+                                      frame.undo)
+            if culprits is not None:
+                self.unpin(frame)
+                return culprits
+        return None
+
+    def unpin(self, frame):
+        '''
+        Undo the pin of the gem of frame and the requirements it added.
+        '''
+        del self.pinned[frame.name]
+        self.changed.append(frame.name)
+        while frame.undo:
+            name, constraint = frame.undo.pop()
+            self.constraints[name] = constraint
+            self.sources[name].pop()
+            self.changed.append(name)
+
+    def learn(self, culprits):
+        '''
+        Remember that the current versions, or requirements, of culprits
+        can not be used together.
+        '''
+        nogood = frozenset(
+            (name, reason, self.nogood_key(name, reason, self.pinned[name]))
+            for name, reason in culprits.items() if name in self.pinned)
+        if not nogood:
+            return
+        for member in nogood:
+            self.nogoods.setdefault(member, set()).add(nogood)
+
+    def resolve(self, roots):
+        '''
+        Returns a map of each needed gem to its pinned version, given the
+        (name, requirement tuple) pairs of the Gemfile. ValueError is raised
+        if no set of versions satisfies all requirements.
+        '''
+        for name, requirement in roots:
+            if "rails-assets" in name:
+                continue
+            if name not in self.constraints:
+                self.constraints[name] = ()
+                self.sources[name] = []
+            merged = merge_requirements(self.constraints[name],
+                                        tuple(requirement))
+            if merged is None:
+                raise ValueError("The Gemfile requires %s as both %s and %s"
+                                 % (name, self.constraints[name],
+                                    requirement))
+            self.constraints[name] = merged
+            self.roots[name] = merged
+            self.changed.append(name)
+        stack = []
+        while True:
+            name = self.select()
+            if name is None:
+                return dict(self.pinned)
+            stack.append(Frame(name, self.candidates(name),
+                               [source for source, requirement
+                                in self.sources[name]]))
+            while True:
+                frame = stack[-1]
+                pinned = False
+                while frame.position < len(frame.candidates):
+                    version = frame.candidates[frame.position]
+                    frame.position = frame.position + 1
+                    culprits = self.pin(frame, version)
+                    if culprits is None:
+                        pinned = True
+                        break
+                    add_culprits(frame.conflicts, culprits)
+                if pinned:
+                    break
+                # No version of frame.name fits: jump back to the latest
+                # gem responsible, skipping the unrelated ones in between
+                stack.pop()
+                self.changed.append(frame.name)
+                culprits = dict(frame.conflicts)
+                culprits.pop(frame.name, None)
+                self.learn(culprits)
+                self.backtracks = self.backtracks + 1
+                while stack and stack[-1].name not in culprits:
+                    self.unpin(stack.pop())
+                if not stack:
+                    raise ValueError("No versions of the gems satisfy all "
+                                     "requirements on %s: %s" %
+                                     (frame.name,
+                                      list(self.constraints[frame.name])))
+                log.debug("Conflict on %s, backtracking to %s",
+                          frame.name, stack[-1].name)
+                self.unpin(stack[-1])
+                culprits.pop(stack[-1].name)
+                add_culprits(stack[-1].conflicts, culprits)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+import gzip
+import io
+import json
+import mmap
+import os
+import random
+import socket
+import threading
+import time
+
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from queue import Empty, Full, LifoQueue
+from urllib.parse import urlparse
+
+from .metrics import Metrics
+from .util import (index_is_current, index_sources, save_index_sources,
+                   search_index)
+
+RUBYGEMS_URL = 'https://rubygems.org'
+
+
+class RubygemsClient(object):
+    '''
+    HTTP client for the Rubygems API, shared by all requests of a run.
+
+    It keeps a pool of up to pool_size keep-alive connections, asks for
+    gzip compressed responses, sends at most rate requests per second if
+    rate is set, and retries connection errors and 429/5xx responses up to
+    retries times with exponential backoff. base_url can point to a mirror
+    or a local stand-in server instead of rubygems.org. Requests, retries
+    and bytes fetched are counted in metrics.
+    '''
+
+    def __init__(self, base_url=RUBYGEMS_URL, pool_size=4, rate=None,
+                 retries=3, backoff=1.0, timeout=60, metrics=None):
+        '''
+        Initialize attributes.
+        '''
+        url = urlparse(base_url)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.prefix = url.path.rstrip('/')
+        self.pool = LifoQueue(pool_size)
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.next_request = 0
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+
+    def connect(self):
+        '''
+        Return a new connection to the server.
+        '''
+        if self.scheme == 'http':
+            return HTTPConnection(self.netloc, timeout=self.timeout)
+        return HTTPSConnection(self.netloc, timeout=self.timeout)
+
+    def acquire(self):
+        '''
+        Return an idle connection from the pool, or a new one, and whether it
+        was reused.
+        '''
+        try:
+            return self.pool.get_nowait(), True
+        except Empty:
+            return self.connect(), False
+
+    def release(self, connection):
+        '''
+        Return a connection to the pool, closing it if the pool is full.
+        '''
+        try:
+            self.pool.put_nowait(connection)
+        except Full:
+            connection.close()
+
+    def wait_for_rate(self):
+        '''
+        Sleep until the request budget allows another request.
+        '''
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_request)
+            self.next_request = start + 1.0 / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+    def retry_delay(self, attempt, headers=None):
+        '''
+        Return the seconds to wait before retrying, honouring Retry-After.
+        '''
+        if headers is not None:
+            retry_after = headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                return int(retry_after)
+        return self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    def get(self, path, headers={}):
+        '''
+        Send a GET request for path and return the response status, headers
+        and decompressed body.
+        '''
+        request_headers = {'Accept-Encoding': 'gzip'}
+        request_headers.update(headers)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.metrics.increment('rubygems_retries')
+            self.wait_for_rate()
+            connection, reused = self.acquire()
+            self.metrics.increment('rubygems_requests')
+            start = time.time()
+            try:
+                connection.request('GET', self.prefix + path,
+                                   headers=request_headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (HTTPException, socket.error):
+                self.metrics.record('rubygems_request', time.time() - start)
+                connection.close()
+                if attempt == self.retries:
+                    raise
+                # A pooled connection may just have been closed by the
+                # server, so only wait if a fresh one failed
+                if not reused:
+                    time.sleep(self.retry_delay(attempt))
+                continue
+            self.metrics.record('rubygems_request', time.time() - start)
+            self.release(connection)
+            self.metrics.increment('rubygems_bytes', len(body))
+            if response.status == 429 or response.status >= 500:
+                if attempt < self.retries:
+                    time.sleep(self.retry_delay(attempt, response.msg))
+                    continue
+            if response.msg.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            return response.status, response.msg, body
+
+
+def parse_info(name, text):
+    '''
+    Convert a compact index info file of a gem into the list of versions
+    returned by the dependencies API.
+
+    Each line of the file is "VERSION[-PLATFORM] DEPENDENCIES|METADATA",
+    where DEPENDENCIES is a comma separated list of "name:requirement"
+    items with clauses of a requirement joined by "&".
+    '''
+    versions = []
+    for line in text.splitlines():
+        if not line or line == '---':
+            continue
+        version, _, rest = line.partition(' ')
+        number, _, platform = version.partition('-')
+        dependencies = []
+        for dependency in rest.partition('|')[0].split(','):
+            if dependency:
+                dep_name, _, requirement = dependency.partition(':')
+                dependencies.append(
+                    [dep_name, ', '.join(requirement.split('&'))])
+        versions.append({'name': name,
+                         'number': number,
+                         'platform': platform or 'ruby',
+                         'dependencies': dependencies})
+    return versions
+
+
+class CompactIndex(object):
+    '''
+    Rubygems information read from a local copy of the compact index, the
+    info/<gem> files served by rubygems.org, as an offline alternative to
+    the dependencies API.
+
+    If index_path is given, all info files are converted once into lines of
+    "name<TAB>versions as JSON" sorted by name, which later runs memory map
+    and search by bisection. The index is rebuilt when an info file is
+    added, removed or changed, or another info directory is given. Without
+    an index, the info file of a gem is read when it is asked for.
+    '''
+
+    def __init__(self, path, index_path=None):
+        '''
+        Initialize attributes. path is the directory holding info/, or the
+        info directory itself.
+        '''
+        if os.path.isdir(os.path.join(path, 'info')):
+            path = os.path.join(path, 'info')
+        self.path = path
+        self.index_path = index_path
+        self.index = None
+        if index_path:
+            self.load()
+
+    def load(self):
+        '''
+        Memory map the index, building it first if it is missing or was
+        built from other info files.
+        '''
+        sources = index_sources(
+            (name, os.path.join(self.path, name))
+            for name in os.listdir(self.path))
+        if not index_is_current(self.index_path, sources):
+            self.build()
+            save_index_sources(self.index_path, sources)
+        with open(self.index_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def build(self):
+        '''
+        Convert all info files into the index.
+        '''
+        tmp_path = self.index_path + '.tmp'
+        with io.open(tmp_path, 'w', encoding='utf-8') as f:
+            for name in sorted(os.listdir(self.path)):
+                f.write(u'%s\t%s\n' % (name, json.dumps(self.read_info(name))))
+        os.rename(tmp_path, self.index_path)
+
+    def read_info(self, name):
+        '''
+        Return the versions of a gem from its info file.
+        '''
+        info_path = os.path.join(self.path, name)
+        if not os.path.exists(info_path):
+            return []
+        with io.open(info_path, encoding='utf-8') as f:
+            return parse_info(name, f.read())
+
+    def get(self, name):
+        '''
+        Return the versions of a gem, in the format of the dependencies API.
+        '''
+        if self.index_path:
+            if self.index is None:
+                return []
+            for fields in search_index(self.index, name):
+                return json.loads(fields[1])
+            return []
+        return self.read_info(name)
@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 
+import json
+import logging
+import os
 import re
-from distutils.version import LooseVersion
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
 
 
 GEM_EXCEPTIONS = {'rake': 'rake',
@@ -39,21 +43,419 @@ SKIP_VERSION_CHECK = ['bootstrap-sass',
                       'messagebus_ruby_api',
                       'gitlab_omniauth-ldap']
 
+log = logging.getLogger(__name__)
 
-def get_operator(requirement):
+
+def search_index(index, key):
+    '''
+    Returns the lines of an index whose first field is key, split into
+    fields. The index is a memory mapped file of tab separated lines sorted
+    by their first field, searched by bisection.
+    '''
+    encoded_key = key.encode('utf-8')
+    low, high = 0, len(index)
+    while low < high:
+        middle = (low + high) // 2
+        start = index.rfind(b'\n', 0, middle) + 1
+        end = index.find(b'\n', start)
+        if index[start:index.find(b'\t', start, end)] < encoded_key:
+            low = end + 1
+        else:
+            high = start
+    lines = []
+    while low < len(index):
+        end = index.find(b'\n', low)
+        fields = index[low:end].decode('utf-8').split('\t')
+        if fields[0] != key:
+            break
+        lines.append(fields)
+        low = end + 1
+    return lines
+
+
+def index_sources(files):
+    '''
+    Returns the sorted [key, path, size, mtime] of (key, path) pairs of
+    files, which tell if an index built from them is still current.
+    '''
+    sources = []
+    for key, path in files:
+        stat = os.stat(path)
+        sources.append([key, os.path.abspath(path), stat.st_size,
+                        stat.st_mtime])
+    return sorted(sources)
+
+
+def index_is_current(index_path, sources):
+    '''
+    Returns if the index at index_path was built from sources, as recorded
+    in its index_path.files sidecar by save_index_sources.
     '''
-    Splits the operator and version from a requirement string.
+    try:
+        with open(index_path + '.files') as f:
+            saved = json.load(f)
+    except (IOError, ValueError):
+        return False
+    return os.path.exists(index_path) and saved == sources
+
+
+def save_index_sources(index_path, sources):
+    '''
+    Record the sources the index at index_path was built from.
+    '''
+    tmp_path = index_path + '.files.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(sources, f)
+    os.rename(tmp_path, index_path + '.files')
+
+
+@lru_cache(maxsize=None)
+def parse_requirement(requirement):
     '''
-    print "requirement is : ", requirement
+    Splits the operator and version from a requirement string. An empty
+    requirement is ">= 0" and a bare version is "=". Memoized.
+    '''
+    requirement = requirement.strip()
     if requirement == '':
         return '>=', '0'
-    m = re.search("\d", requirement)
-    pos = m.start()
-    if pos == 0:
+    m = re.search(r"\d", requirement)
+    if m.start() == 0:
         return '=', requirement
-    check = requirement[:pos].strip()
-    ver = requirement[pos:]
-    return check, ver
+    return requirement[:m.start()].strip(), requirement[m.start():].strip()
+
+
+@lru_cache(maxsize=None)
+def version_segments(version):
+    '''
+    Splits a version string into numeric and string segments like Rubygems
+    does, so that "1.0.0.rc1" becomes (1, 0, 0, 'rc', 1).
+    '''
+    version = str(version).strip().replace('-', '.pre.')
+    return tuple(int(x) if x.isdigit() else x
+                 for x in re.findall(r'[0-9]+|[a-zA-Z]+', version))
+
+
+@lru_cache(maxsize=4096)
+def version_key(version):
+    '''
+    Returns a tuple that sorts in the same order as Rubygems versions.
+
+    Trailing zeros of the release and prerelease parts are dropped, so that
+    "1.0" equals "1". Numbers become (1, n) and strings (0, s), so that a
+    prerelease sorts before its release. A final (1, 0) stands for the zeros
+    Rubygems pads shorter versions with, so that "1.a" sorts before "1".
+    '''
+    segments = list(version_segments(version))
+    string_start = len(segments)
+    for index, segment in enumerate(segments):
+        if not isinstance(segment, int):
+            string_start = index
+            break
+    release, prerelease = segments[:string_start], segments[string_start:]
+    while release and release[-1] == 0:
+        release.pop()
+    while prerelease and prerelease[-1] == 0:
+        prerelease.pop()
+    key = [(1, x) if isinstance(x, int) else (0, x)
+           for x in release + prerelease]
+    key.append((1, 0))
+    return tuple(key)
+
+
+@lru_cache(maxsize=None)
+def is_prerelease(version):
+    '''
+    Returns if a version is a prerelease, that is, it has a letter in it.
+    '''
+    return any(not isinstance(x, int) for x in version_segments(version))
+
+
+def release_key(version):
+    '''
+    Returns the version_key of a version with its prerelease part removed.
+    '''
+    segments = version_segments(version)
+    release = []
+    for segment in segments:
+        if not isinstance(segment, int):
+            break
+        release.append(str(segment))
+    return version_key('.'.join(release) or '0')
+
+
+@lru_cache(maxsize=None)
+def bump_key(version):
+    '''
+    Returns the version_key of the upper bound of "~> version", so that
+    "~> 1.2.3" allows versions below 1.3 and "~> 1.2" below 2. As in
+    Rubygems, a prerelease is cut at its first string, so that
+    "~> 1.2.3.rc1" also allows versions below 1.3.
+    '''
+    segments = []
+    for segment in version_segments(version):
+        if not isinstance(segment, int):
+            break
+        segments.append(segment)
+    if len(segments) > 1:
+        segments.pop()
+    segments[-1] = segments[-1] + 1
+    return version_key('.'.join(str(x) for x in segments))
+
+
+class Requirement(object):
+    '''
+    A list of requirement clauses, parsed once into (operator, version_key)
+    tuples so that it can be checked against many versions quickly.
+    '''
+
+    def __init__(self, requirements):
+        '''
+        Parse the requirement strings.
+        '''
+        self.requirements = tuple(requirements)
+        self.clauses = []
+        self.prerelease = False
+        for requirement in self.requirements:
+            check, ver = parse_requirement(requirement)
+            if check == '~>':
+                self.clauses.append(('>=', version_key(ver)))
+                self.clauses.append(('~<', bump_key(ver)))
+            else:
+                self.clauses.append((check, version_key(ver)))
+            if is_prerelease(ver):
+                self.prerelease = True
+        self.pessimistic = any(check == '~<' for check, ver in self.clauses)
+
+    def satisfied_by(self, version):
+        '''
+        Returns if version satisfies all the clauses.
+        '''
+        release = None
+        if self.pessimistic:
+            release = release_key(version)
+        return self.check(version_key(version), release)
+
+    def check(self, key, release):
+        '''
+        Returns if the version with version_key key and release_key release
+        satisfies all the clauses. release is only needed for ~>.
+        '''
+        for check, ver in self.clauses:
+            if check == '=':
+                status = key == ver
+            elif check == '!=':
+                status = key != ver
+            elif check == '>':
+                status = key > ver
+            elif check == '>=':
+                status = key >= ver
+            elif check == '<':
+                status = key < ver
+            elif check == '<=':
+                status = key <= ver
+            elif check == '~<':
+                # Upper bound of ~>, prereleases of the bound are excluded
+                status = release < ver
+            else:
+                status = False
+            if not status:
+                return False
+        return True
+
+
+@lru_cache(maxsize=1024)
+def compile_requirement(requirements):
+    '''
+    Returns a memoized Requirement for a tuple of requirement strings.
+    '''
+    return Requirement(requirements)
+
+
+class VersionIndex(object):
+    '''
+    The versions of a gem sorted by version_key. The bounds of a requirement
+    are found by bisection, so that only the versions between them have to
+    be checked.
+    '''
+
+    def __init__(self, versions):
+        '''
+        Sort the versions, and compute their keys and prerelease flags once.
+        '''
+        self.versions = sorted(set(versions), key=version_key)
+        self.keys = [version_key(version) for version in self.versions]
+        self.releases = [release_key(version) for version in self.versions]
+        self.prereleases = [is_prerelease(version)
+                            for version in self.versions]
+
+    def bounds(self, requirement):
+        '''
+        Returns the range of positions of versions within the bounds of a
+        compiled requirement.
+        '''
+        low, high = 0, len(self.keys)
+        for check, ver in requirement.clauses:
+            if check in ('>=', '='):
+                low = max(low, bisect_left(self.keys, ver))
+            elif check == '>':
+                low = max(low, bisect_right(self.keys, ver))
+            if check in ('<', '~<'):
+                high = min(high, bisect_left(self.keys, ver))
+            elif check in ('<=', '='):
+                high = min(high, bisect_right(self.keys, ver))
+        return low, high
+
+    def matches(self, requirement, position):
+        '''
+        Returns if the version at position satisfies a compiled requirement.
+        As in Bundler, prereleases only match if the requirement names one.
+        '''
+        return requirement.check(self.keys[position],
+                                 self.releases[position]) and \
+            (requirement.prerelease or not self.prereleases[position])
+
+    def least(self, requirements):
+        '''
+        Returns the smallest version that satisfies requirements, or None.
+        '''
+        compiled = compile_requirement(tuple(requirements))
+        low, high = self.bounds(compiled)
+        for position in range(low, high):
+            if self.matches(compiled, position):
+                return self.versions[position]
+        return None
+
+    def highest(self, requirements):
+        '''
+        Returns the largest version that satisfies requirements, or None.
+        '''
+        compiled = compile_requirement(tuple(requirements))
+        low, high = self.bounds(compiled)
+        for position in range(high - 1, low - 1, -1):
+            if self.matches(compiled, position):
+                return self.versions[position]
+        return None
+
+    def satisfying(self, requirements):
+        '''
+        Returns all versions that satisfy requirements, smallest first.
+        '''
+        compiled = compile_requirement(tuple(requirements))
+        low, high = self.bounds(compiled)
+        return [self.versions[position] for position in range(low, high)
+                if self.matches(compiled, position)]
+
+
+class Interval(object):
+    '''
+    The range of versions allowed by a list of requirements: a lower bound,
+    an upper bound and excluded versions.
+
+    Bounds are (version_key, rank, requirement) tuples, where rank orders
+    bounds of the same version, so that the strictest lower bound is the
+    largest tuple and the strictest upper bound the smallest. Lower bounds
+    of rank 2 and upper bounds of rank 1 or less exclude their version.
+    An "=" ranks as the strictest inclusive bound, so that it is kept over
+    an equivalent ">=" or "<=". requirement is the string the bound came
+    from.
+    '''
+
+    def __init__(self, requirements=()):
+        '''
+        Parse the requirement strings.
+        '''
+        self.lower = None
+        self.upper = None
+        self.excluded = {}
+        for requirement in requirements:
+            requirement = requirement.strip()
+            check, ver = parse_requirement(requirement)
+            if check in ('>=', '~>'):
+                self.add_lower((version_key(ver), 0, requirement))
+            elif check == '=':
+                self.add_lower((version_key(ver), 1, requirement))
+            elif check == '>':
+                self.add_lower((version_key(ver), 2, requirement))
+            if check == '=':
+                self.add_upper((version_key(ver), 2, requirement))
+            elif check == '<=':
+                self.add_upper((version_key(ver), 3, requirement))
+            elif check == '<':
+                self.add_upper((version_key(ver), 1, requirement))
+            elif check == '~>':
+                # Prereleases of the bound are excluded too, so this is
+                # stricter than < on the same version
+                self.add_upper((bump_key(ver), 0, requirement))
+            elif check == '!=':
+                self.excluded[version_key(ver)] = requirement
+
+    def add_lower(self, bound):
+        '''
+        Keep bound if it is stricter than the current lower bound.
+        '''
+        if self.lower is None or bound > self.lower:
+            self.lower = bound
+
+    def add_upper(self, bound):
+        '''
+        Keep bound if it is stricter than the current upper bound.
+        '''
+        if self.upper is None or bound < self.upper:
+            self.upper = bound
+
+    def intersect(self, other):
+        '''
+        Returns the Interval of versions allowed by both intervals.
+        '''
+        interval = Interval()
+        for bound in (self.lower, other.lower):
+            if bound is not None:
+                interval.add_lower(bound)
+        for bound in (self.upper, other.upper):
+            if bound is not None:
+                interval.add_upper(bound)
+        interval.excluded.update(self.excluded)
+        interval.excluded.update(other.excluded)
+        return interval
+
+    def is_empty(self):
+        '''
+        Returns if no version can be in the interval.
+        '''
+        if self.lower is None or self.upper is None:
+            return False
+        if self.lower[0] != self.upper[0]:
+            return self.lower[0] > self.upper[0]
+        # Only a single version fits, if both bounds include it
+        return self.lower[1] == 2 or self.upper[1] < 2 or \
+            self.lower[0] in self.excluded
+
+    def requirements(self):
+        '''
+        Returns requirement strings allowing exactly the versions of the
+        interval.
+        '''
+        requirements = []
+        if self.lower is not None:
+            requirements.append(self.lower[2])
+        if self.upper is not None and self.upper[2] not in requirements:
+            requirements.append(self.upper[2])
+        for key in sorted(self.excluded):
+            requirements.append(self.excluded[key])
+        return requirements
+
+
+@lru_cache(maxsize=4096)
+def merge_requirements(requirements1, requirements2):
+    '''
+    Returns the requirement strings allowing the versions that satisfy both
+    tuples of requirement strings, as a tuple, or None if no version can.
+    Memoized.
+    '''
+    interval = Interval(requirements1).intersect(Interval(requirements2))
+    if interval.is_empty():
+        return None
+    return tuple(interval.requirements())
 
 
 def get_stricter(requirements1, requirements2):
@@ -63,34 +465,31 @@ def get_stricter(requirements1, requirements2):
     stricter = None
     for requirement1 in requirements1:
         for requirement2 in requirements2:
-            check1, ver1 = get_operator(requirement1)
-            check2, ver2 = get_operator(requirement2)
+            check1, ver1 = parse_requirement(requirement1)
+            check2, ver2 = parse_requirement(requirement2)
             if check1 == '=':
                 stricter = requirement1
             elif check2 == '=':
                 stricter = requirement2
             elif check1 == '>' or check1 == '>=':
                 if check2 == '>' or check2 == '>=':
-                    ver1 = LooseVersion(str(ver1))
-                    ver2 = LooseVersion(str(ver2))
-                    result = requirement1 if ver1 >= ver2 else requirement2
+                    result = requirement1 if version_key(ver1) >= \
+                        version_key(ver2) else requirement2
                     stricter = result
                     # Return stricter
                 elif check2 == '<' or check2 == '<=':
                     stricter = requirement1
                 elif check2 == '~>':
-                    ver1 = LooseVersion(str(ver1))
-                    ver2 = LooseVersion(str(ver2))
-                    if len(ver2.version) > 1:
+                    if len(version_segments(ver2)) > 1:
                         result = requirement2
                     else:
-                        result = requirement1 if ver1 >= ver2 else requirement2
+                        result = requirement1 if version_key(ver1) >= \
+                            version_key(ver2) else requirement2
                     stricter = result
             elif check1 == '<' or check1 == '<=':
                 if check2 == '<' or check2 == '<=':
-                    ver1 = LooseVersion(str(ver1))
-                    ver2 = LooseVersion(str(ver2))
-                    result = requirement1 if ver1 <= ver2 else requirement2
+                    result = requirement1 if version_key(ver1) <= \
+                        version_key(ver2) else requirement2
                     stricter = result
                     # Return smallest
                 elif check2 == '>' or check2 == '>=':
@@ -99,18 +498,16 @@ def get_stricter(requirements1, requirements2):
                     stricter = requirement2
             elif check1 == '~>':
                 if check2 == '~>':
-                    ver1 = LooseVersion(str(ver1))
-                    ver2 = LooseVersion(str(ver2))
-                    result = requirement1 if ver1 <= ver2 else requirement2
+                    result = requirement1 if version_key(ver1) <= \
+                        version_key(ver2) else requirement2
                     stricter = result
                     # Return smallest
                 elif check2 == '>' or check2 == '>=':
-                    ver1 = LooseVersion(str(ver1))
-                    ver2 = LooseVersion(str(ver2))
-                    if len(ver2.version) > 1:
+                    if len(version_segments(ver2)) > 1:
                         result = requirement2
                     else:
-                        result = requirement1 if ver1 >= ver2 else requirement2
+                        result = requirement1 if version_key(ver1) >= \
+                            version_key(ver2) else requirement2
                     stricter = result
                 elif check2 == '<' or check2 == '<=':
                     stricter = requirement1
@@ -121,57 +518,5 @@ def version_satisfy_requirement(requirements, input_version):
     '''
     Returns if input_version satisfies requirement.
     '''
-    status = True
-    for requirement in requirements:
-        check, ver = get_operator(requirement)
-        input_version = LooseVersion(str(input_version))
-        ver = LooseVersion(str(ver))
-        status = False
-        if check == '=' and input_version == ver:
-            status = True
-        elif check == '<=' and input_version <= ver:
-            status = True
-        elif check == '<' and input_version < ver:
-            status = True
-        elif check == '>' and input_version > ver:
-            status = True
-        elif check == '>=' and input_version >= ver:
-            status = True
-        elif check == '!=' and input_version != ver:
-            status = True
-        elif check == '~>':
-            status = True
-            input_version_int = input_version.version
-            ver_int = ver.version
-            n = min(len(input_version_int), len(ver_int)) - 1
-            partcount = 0
-            while partcount < n:
-                if input_version_int[partcount] != ver_int[partcount]:
-                    status = False
-                    break
-                partcount += 1
-            if partcount < len(input_version_int):
-                try:
-                    intdebver = input_version_int[partcount]
-                    intver = ver_int[partcount]
-                    if intdebver < intver:
-                        status = False
-                except:
-                    if input_version_int[partcount] < ver_int[partcount]:
-                        status = False
-            else:
-                status = False
-        if not status:
-            break
-    return status
-
-
-def least_satisfiable_version(requirement, version_list):
-    '''
-    Returns the smallest version that satisfies requirement.
-    '''
-    satisfied_list = []
-    for version in version_list:
-        if version_satisfy_requirement(requirement, version):
-            satisfied_list.append(LooseVersion(str(version)))
-    return str(min(satisfied_list))
+    return compile_requirement(tuple(requirements)).satisfied_by(
+        input_version)
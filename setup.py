@@ -38,6 +38,7 @@ gemdeps is released under `GNU GPL version 3 (or above) License`_.
 ''',
     'packages': ['gemdeps'],
     'scripts': ['bin/gemdeps'],
+    'python_requires': '>=3.7',
     'name': 'gemdeps'
 }
 
@@ -46,6 +47,7 @@ setup(
         # Indicate who your project is intended for
         'Intended Audience :: Developers',
         'License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
     ], **config)
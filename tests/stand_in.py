@@ -0,0 +1,52 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    '''
+    Answers each request with the next of the responses of the server, or
+    with its default response once they are used up. A response of None
+    closes the connection without answering.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.server.responses:
+            response = self.server.responses.pop(0)
+        else:
+            response = self.server.default
+        if response is None:
+            self.close_connection = True
+            return
+        status, headers, body = response
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(test, responses=(), default=(200, {}, b'[]')):
+    '''
+    Start a local HTTP server answering with responses, stopped when test
+    ends. Its url attribute is the base URL to give to RubygemsClient, and
+    requests lists the (path, headers) of the requests it received.
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.responses = list(responses)
+    server.default = default
+    server.requests = []
+    server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    return server
@@ -0,0 +1,104 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from gemdeps import DependencyCache, GemDeps, RubygemsClient
+from stand_in import start_server
+
+RACK = json.dumps([{'name': 'rack', 'number': '2.0.1', 'platform': 'ruby',
+                    'dependencies': []}])
+
+
+class DependencyCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def dependency_cache(self, **kwargs):
+        cache = DependencyCache(os.path.join(self.tmp_dir, 'cache.db'),
+                                **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_least_recently_used_are_evicted(self):
+        cache = self.dependency_cache(max_size=25)
+        cache.put('rack', 'x' * 10)
+        time.sleep(0.01)
+        cache.put('rails', 'x' * 10)
+        time.sleep(0.01)
+        cache.get('rack')
+        time.sleep(0.01)
+        cache.put('json', 'x' * 10)
+        self.assertIsNotNone(cache.get('rack'))
+        self.assertIsNone(cache.get('rails'))
+        self.assertIsNotNone(cache.get('json'))
+
+    def test_entries_are_kept_across_runs(self):
+        self.dependency_cache().put('rack', RACK, '"abc"',
+                                    'Tue, 18 Oct 2016 10:00:00 GMT')
+        cached = self.dependency_cache().get('rack')
+        self.assertEqual(cached.body, RACK)
+        self.assertEqual(cached.etag, '"abc"')
+        self.assertEqual(cached.last_modified,
+                         'Tue, 18 Oct 2016 10:00:00 GMT')
+
+    def test_ttl(self):
+        cache = self.dependency_cache(ttl=0)
+        cache.put('rack', RACK)
+        self.assertFalse(cache.is_fresh(cache.get('rack')))
+        cache = self.dependency_cache(ttl=3600)
+        self.assertTrue(cache.is_fresh(cache.get('rack')))
+        cache = self.dependency_cache(ttl=0, offline=True)
+        self.assertTrue(cache.is_fresh(cache.get('rack')))
+
+
+class RevalidationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def gemdeps(self, server, **kwargs):
+        cache = DependencyCache(os.path.join(self.tmp_dir, 'cache.db'),
+                                **kwargs)
+        self.addCleanup(cache.close)
+        client = RubygemsClient(server.url, retries=0)
+        return GemDeps('app', archive=object(), cache=cache, client=client)
+
+    def test_not_modified(self):
+        server = start_server(self, [(200, {'ETag': '"abc"'},
+                                      RACK.encode('utf-8')),
+                                     (304, {}, b'')])
+        self.gemdeps(server).get_gem_info('rack')
+        app = self.gemdeps(server, ttl=0)
+        self.assertEqual(app.get_gem_info('rack'), json.loads(RACK))
+        self.assertEqual(server.requests[1][1]['If-None-Match'], '"abc"')
+        self.assertEqual(app.metrics.counters['dependency_cache_revalidated'],
+                         1)
+        # The entry is fresh again for a later run
+        app = self.gemdeps(server, ttl=3600)
+        app.get_gem_info('rack')
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(app.metrics.counters['dependency_cache_hits'], 1)
+
+    def test_modified(self):
+        changed = json.dumps([{'name': 'rack', 'number': '2.0.3',
+                               'platform': 'ruby', 'dependencies': []}])
+        server = start_server(self, [(200, {'ETag': '"abc"'},
+                                      RACK.encode('utf-8')),
+                                     (200, {'ETag': '"def"'},
+                                      changed.encode('utf-8'))])
+        self.gemdeps(server).get_gem_info('rack')
+        app = self.gemdeps(server, ttl=0)
+        self.assertEqual(app.get_gem_info('rack'), json.loads(changed))
+        self.assertEqual(app.cache.get('rack').etag, '"def"')
+
+    def test_offline_miss(self):
+        server = start_server(self)
+        app = self.gemdeps(server, offline=True)
+        with self.assertRaises(IOError):
+            app.get_gem_info('rack')
+        with self.assertRaises(IOError):
+            app.fetch_gem_infos(['rack'])
+        self.assertEqual(server.requests, [])
@@ -0,0 +1,44 @@
+import os
+import socket
+import tempfile
+import unittest
+
+from gemdeps import daemon
+
+
+class SocketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'gemdeps.sock')
+
+    def listen(self):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen(1)
+        self.addCleanup(server.close)
+
+    def test_missing_socket(self):
+        self.assertFalse(daemon.is_running(self.path))
+
+    def test_own_socket(self):
+        self.listen()
+        daemon.check_socket(self.path)
+        self.assertTrue(daemon.is_running(self.path))
+
+    def test_not_a_socket(self):
+        with open(self.path, 'w'):
+            pass
+        with self.assertRaises(IOError):
+            daemon.check_socket(self.path)
+        self.assertFalse(daemon.is_running(self.path))
+        with self.assertRaises(IOError):
+            daemon.query({'command': 'status'}, self.path)
+
+    @unittest.skipUnless(os.getuid() == 0, "needs to change the owner")
+    def test_socket_of_another_user(self):
+        self.listen()
+        os.chown(self.path, 65534, -1)
+        with self.assertRaises(IOError):
+            daemon.check_socket(self.path)
+        self.assertFalse(daemon.is_running(self.path))
@@ -0,0 +1,214 @@
+import gzip
+import lzma
+import os
+import stat
+import tempfile
+import time
+import unittest
+
+from gemdeps.cache import StatusCache
+from gemdeps.debian import (SUITES, CachedArchive, CommandRunner,
+                            LocalArchive)
+
+
+class CommandRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def script(self, name, body):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n' + body)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        return path
+
+    def test_output(self):
+        runner = CommandRunner()
+        command = self.script('tool', 'echo "$1"\n')
+        self.assertEqual(runner.run([command, 'ruby-foo']), 'ruby-foo\n')
+        self.assertEqual(runner.metrics.counters['tool_calls'], 1)
+
+    def test_timeout_kills_grandchildren(self):
+        # The sleep keeps stdout open after the shell itself is killed,
+        # like the curl started by rmadison
+        command = self.script('hanging', 'sleep 30 &\nsleep 30\n')
+        runner = CommandRunner(timeout=1, retries=1, backoff=0.01)
+        start = time.time()
+        with self.assertRaises(IOError):
+            runner.run([command])
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(runner.metrics.counters['hanging_retries'], 1)
+        self.assertEqual(runner.metrics.counters['hanging_failures'], 1)
+
+    def test_curl_error_is_retried(self):
+        command = self.script('failing', 'echo "curl: (6) no host"\n')
+        runner = CommandRunner(retries=2, backoff=0.01)
+        with self.assertRaises(IOError):
+            runner.run([command])
+        self.assertEqual(runner.metrics.counters['failing_calls'], 3)
+        self.assertEqual(len(runner.failures), 1)
+
+
+class FakeArchive(object):
+    '''
+    Archive with fixed versions and WNPP bugs, counting lookups.
+    '''
+
+    def __init__(self, versions, wnpp):
+        self.versions = versions
+        self.wnpp = wnpp
+        self.lookups = []
+
+    def prefetch(self, packages):
+        self.lookups.extend(packages)
+
+    def get_version(self, package, suite):
+        return self.versions.get(package, {}).get(suite)
+
+    def get_wnpp(self, package):
+        self.lookups.append(package)
+        return self.wnpp.get(package)
+
+
+class CachedArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = StatusCache(os.path.join(self.tmp_dir, 'status.db'))
+        self.addCleanup(self.cache.close)
+
+    def test_wnpp(self):
+        archive = FakeArchive({}, {'ruby-foo': ('ITP', '123456')})
+        cached = CachedArchive(archive, self.cache)
+        self.assertEqual(cached.get_wnpp('ruby-foo'), ('ITP', '123456'))
+        self.assertIsNone(cached.get_wnpp('ruby-bar'))
+        self.assertEqual(cached.get_wnpp('ruby-foo'), ('ITP', '123456'))
+        self.assertIsNone(cached.get_wnpp('ruby-bar'))
+        self.assertEqual(archive.lookups, ['ruby-foo', 'ruby-bar'])
+
+    def test_metrics(self):
+        self.cache.put([('ruby-foo', suite, '') for suite in SUITES])
+        archive = FakeArchive({'ruby-bar': {'unstable': '1.0-1'}}, {})
+        cached = CachedArchive(archive, self.cache)
+        cached.prefetch(['ruby-foo', 'ruby-bar'])
+        self.assertEqual(archive.lookups, ['ruby-bar'])
+        for package in ['ruby-foo', 'ruby-bar']:
+            for suite in SUITES:
+                cached.get_version(package, suite)
+        self.assertEqual(cached.get_version('ruby-bar', 'unstable'), '1.0-1')
+        cached.get_wnpp('ruby-bar')
+        # One lookup per package and suite, missed only once when fetched
+        self.assertEqual(cached.metrics.counters['status_cache_hits'], 4)
+        self.assertEqual(cached.metrics.counters['status_cache_misses'], 4)
+
+
+SOURCES = """Package: ruby-rack
+Binary: ruby-rack
+Version: 1.6.4-3
+Maintainer: Debian Ruby Extras Maintainers
+ <pkg-ruby-extras-maintainers@lists.alioth.debian.org>
+
+Package: rails
+Version: 2:4.2.6-1
+"""
+
+PACKAGES = """Package: ruby-rack
+Version: 2.0.1-1
+Architecture: all
+
+Package: nokogiri
+Version: 1.6.8-1+b1
+Source: ruby-nokogiri (1.6.8-1)
+
+Package: ruby-mini-portile2
+Source: ruby-mini-portile2
+Version: 2.1.0-1
+"""
+
+
+class LocalArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.tmp_dir, 'index')
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp_dir, name)
+        opener = {'.gz': gzip.open, '.xz': lzma.open}.get(
+            os.path.splitext(name)[1], open)
+        with opener(path, 'wt') as f:
+            f.write(text)
+        return path
+
+    def test_versions(self):
+        sources = self.write('Sources.xz', SOURCES)
+        packages = self.write('Packages.gz', PACKAGES)
+        for index_path in (None, self.index_path):
+            archive = LocalArchive([('sid', sources),
+                                    ('experimental', packages)],
+                                   index_path)
+            self.assertEqual(archive.get_version('ruby-rack', 'unstable'),
+                             '1.6.4-3')
+            self.assertEqual(archive.get_version('ruby-rack',
+                                                 'experimental'),
+                             '2.0.1-1')
+            # Binary packages are also listed under their source
+            self.assertEqual(archive.get_version('nokogiri', 'experimental'),
+                             '1.6.8-1+b1')
+            self.assertEqual(archive.get_version('ruby-nokogiri',
+                                                 'experimental'),
+                             '1.6.8-1')
+            self.assertEqual(archive.get_version('ruby-mini-portile2',
+                                                 'experimental'),
+                             '2.1.0-1')
+            self.assertIsNone(archive.get_version('ruby-rack', 'new'))
+            self.assertIsNone(archive.get_version('ruby-zzz', 'unstable'))
+            self.assertIsNone(archive.get_version('a', 'unstable'))
+
+    def test_search_every_package(self):
+        names = ['ruby-%03d' % number for number in range(200)]
+        sources = self.write('Sources', ''.join(
+            'Package: %s\nVersion: 1.%d-1\n\n' % (name, number)
+            for number, name in enumerate(reversed(names))))
+        archive = LocalArchive([('unstable', sources)], self.index_path)
+        for number, name in enumerate(reversed(names)):
+            self.assertEqual(archive.get_version(name, 'unstable'),
+                             '1.%d-1' % number)
+        self.assertIsNone(archive.get_version('ruby-0', 'unstable'))
+        self.assertIsNone(archive.get_version('ruby-999', 'unstable'))
+
+    def test_saved_index_is_reused(self):
+        sources = self.write('Sources', SOURCES)
+        LocalArchive([('unstable', sources)], self.index_path)
+        with open(self.index_path) as f:
+            self.assertEqual(f.readline(), 'rails\tunstable\t2:4.2.6-1\n')
+        inode = os.stat(self.index_path).st_ino
+        archive = LocalArchive([('unstable', sources)], self.index_path)
+        self.assertEqual(archive.get_version('rails', 'unstable'),
+                         '2:4.2.6-1')
+        # A rebuilt index would have replaced the file
+        self.assertEqual(os.stat(self.index_path).st_ino, inode)
+
+    def test_index_is_rebuilt_for_changed_files(self):
+        sources = self.write('Sources', SOURCES)
+        archive = LocalArchive([('unstable', sources)], self.index_path)
+        self.write('Sources', SOURCES.replace('1.6.4-3', '1.6.4-4'))
+        # The same size, but a later modification time
+        mtime = os.path.getmtime(sources) + 10
+        os.utime(sources, (mtime, mtime))
+        archive.clear()
+        self.assertEqual(archive.get_version('ruby-rack', 'unstable'),
+                         '1.6.4-4')
+
+    def test_index_is_rebuilt_for_other_files(self):
+        packages = self.write('Packages.gz', 'Package: ruby-zzz\n'
+                              'Version: 3-1\n')
+        sources = self.write('Sources.xz', 'Package: ruby-foo\n'
+                             'Version: 1.0-1\n')
+        LocalArchive([('experimental', packages), ('unstable', sources)],
+                     self.index_path)
+        archive = LocalArchive([('unstable', sources)], self.index_path)
+        self.assertIsNone(archive.get_version('ruby-zzz', 'experimental'))
+        self.assertEqual(archive.get_version('ruby-foo', 'unstable'),
+                         '1.0-1')
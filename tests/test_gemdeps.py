@@ -0,0 +1,257 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from gemdeps import (DependencyCache, DetailedDependency, GemDeps,
+                     GemDepsBatch)
+
+try:
+    import gemfileparser
+except ImportError:
+    gemfileparser = None
+
+RACK = [{'name': 'rack', 'number': '2.0.1', 'platform': 'ruby',
+         'dependencies': []}]
+RAILS = [{'name': 'rails', 'number': '5.0.0', 'platform': 'ruby',
+          'dependencies': [['rack', '~> 2.0']]}]
+
+
+class FakeClient(object):
+    '''
+    Answers Rubygems API requests from a map of gem name to versions, and
+    304 to conditional requests.
+    '''
+
+    def __init__(self, gems):
+        self.gems = gems
+        self.requests = []
+
+    def get(self, path, headers={}):
+        self.requests.append((path, dict(headers)))
+        if 'If-Modified-Since' in headers or 'If-None-Match' in headers:
+            return 304, {}, b''
+        names = path.split('gems=')[1].split(',')
+        body = [version for name in names
+                for version in self.gems.get(name, [])]
+        return 200, {'Last-Modified': 'Tue, 18 Oct 2016 10:00:00 GMT'}, \
+            json.dumps(body).encode('utf-8')
+
+
+class FetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.client = FakeClient({'rack': RACK, 'rails': RAILS})
+
+    def gemdeps(self, ttl):
+        cache = DependencyCache(os.path.join(self.tmp_dir, 'cache.db'), ttl)
+        self.addCleanup(cache.close)
+        return GemDeps('app', archive=object(), cache=cache,
+                       client=self.client)
+
+    def test_batch_keeps_validators(self):
+        self.gemdeps(3600).fetch_gem_infos(['rack', 'rails'])
+        self.assertEqual(len(self.client.requests), 1)
+        cached = self.gemdeps(3600).cache.get('rails')
+        self.assertEqual(cached.last_modified,
+                         'Tue, 18 Oct 2016 10:00:00 GMT')
+
+    def test_stale_entries_are_revalidated(self):
+        self.gemdeps(3600).fetch_gem_infos(['rack', 'rails'])
+        app = self.gemdeps(0)
+        app.fetch_gem_infos(['rack', 'rails'])
+        conditional = self.client.requests[1:]
+        self.assertEqual(len(conditional), 2)
+        for path, headers in conditional:
+            self.assertIn('If-Modified-Since', headers)
+        self.assertEqual(app.gem_info['rails'], RAILS)
+        self.assertEqual(app.metrics.counters['dependency_cache_revalidated'],
+                         2)
+
+    def test_fresh_entries_are_used(self):
+        self.gemdeps(3600).fetch_gem_infos(['rack'])
+        app = self.gemdeps(3600)
+        app.fetch_gem_infos(['rack', 'rails'])
+        self.assertEqual(self.client.requests[1][0].split('gems=')[1],
+                         'rails')
+        self.assertEqual(app.gem_info['rack'], RACK)
+        self.assertEqual(app.metrics.counters['dependency_cache_hits'], 1)
+
+
+class Dependency(object):
+    '''
+    Stands for a GemfileParser.Dependency.
+    '''
+
+    def __init__(self, name, requirement):
+        self.name = name
+        self.requirement = requirement
+        self.autorequire = ''
+        self.source = ''
+        self.parent = []
+        self.group = ''
+
+
+class FakeArchive(object):
+
+    def prefetch(self, packages):
+        pass
+
+    def get_version(self, package, suite):
+        return None
+
+    def get_wnpp(self, package):
+        return None
+
+
+class StateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def save(self, nodes):
+        state = {}
+        for name, suite, checked in nodes:
+            state[name] = {'version': '1.0-1', 'suite': suite,
+                           'status': suite, 'link': '', 'satisfied': True,
+                           'color': 'blue', 'requirement': ['>= 1.0'],
+                           'parent': [], 'dependencies': [],
+                           'checked': checked}
+        with open(os.path.join(self.tmp_dir, 'gemdeps_state.json'),
+                  'w') as f:
+            json.dump({'nodes': state}, f)
+
+    def test_new_status_is_kept(self):
+        self.save([('ruby-foo', 'NEW', time.time())])
+        app = GemDeps('app', archive=FakeArchive(), client=object())
+        self.assertTrue(app.load_state(self.tmp_dir))
+        # A changed requirement reuses the saved Debian version
+        gem = DetailedDependency(Dependency('ruby-foo', ['>= 0.9']),
+                                 FakeArchive())
+        gem.debian_status(app.jsoncontent)
+        self.assertEqual(gem.status, 'NEW')
+
+    def test_statuses_expire(self):
+        hours_ago = time.time() - 7200
+        self.save([('ruby-foo', 'NEW', hours_ago),
+                   ('ruby-bar', 'Unstable', hours_ago)])
+        app = GemDeps('app', archive=FakeArchive(), client=object())
+        app.load_state(self.tmp_dir)
+        self.assertNotIn('ruby-foo', app.jsoncontent)
+        self.assertIn('ruby-bar', app.jsoncontent)
+        self.assertIn(('ruby-foo', ('>= 1.0',)), app.selected)
+        app = GemDeps('app', archive=FakeArchive(), client=object())
+        app.load_state(self.tmp_dir, {'unstable': 3600})
+        self.assertNotIn('ruby-bar', app.jsoncontent)
+
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def test_parent_found_later(self):
+        app = GemDeps('app', archive=FakeArchive(), client=object())
+        app.original_list = [Dependency('rails', ['>= 0']),
+                             Dependency('rack', ['>= 0']),
+                             Dependency('sinatra', ['>= 0'])]
+        graph = {'rails': ['rack'], 'sinatra': ['rack']}
+        app.open_streams(self.tmp_dir)
+        # rack is written before sinatra, another parent of it, is reached
+        app.walk(lambda gem: [Dependency(name, ['>= 1.0'])
+                              for name in graph.get(gem.name, [])],
+                 gem_info=False)
+        app.close_streams()
+        with open(os.path.join(self.tmp_dir, 'debian_status.ndjson')) as f:
+            records = [json.loads(line) for line in f]
+        latest = dict((record['name'], record) for record in records)
+        self.assertEqual(latest['rack']['parent'], ['rails', 'sinatra'])
+        self.assertEqual(len(records), 4)
+
+
+class ReuseTest(unittest.TestCase):
+
+    def walk(self, app):
+        graph = {'rails': ['rack'], 'sinatra': ['rack']}
+        app.original_list = [Dependency('rails', ['>= 0']),
+                             Dependency('sinatra', ['>= 0'])]
+        app.walk(lambda gem: [Dependency(name, ['>= 1.0'])
+                              for name in graph.get(gem.name, [])])
+
+    def test_statuses_of_this_run_are_not_reused(self):
+        client = FakeClient({'rack': RACK, 'rails': RAILS})
+        app = GemDeps('app', archive=FakeArchive(), client=client)
+        self.walk(app)
+        self.assertEqual(app.metrics.counters.get('status_reused', 0), 0)
+        # Another app of a batch shares what the first one looked up
+        other = GemDeps('other', archive=FakeArchive(), client=client)
+        other.resolved = app.resolved
+        self.walk(other)
+        self.assertEqual(other.metrics.counters['status_reused'], 3)
+
+
+@unittest.skipIf(gemfileparser is None, "needs gemfileparser")
+class LockfileTest(unittest.TestCase):
+
+    def test_dependencies_are_the_roots(self):
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'Gemfile.lock')
+        with open(path, 'w') as f:
+            f.write('GEM\n  specs:\n    rack (2.0.1)\n'
+                    '    rails (5.0.0)\n      rack (~> 2.0)\n\n'
+                    'DEPENDENCIES\n  rails\n')
+        app = GemDeps('app', archive=FakeArchive(), client=object())
+        app.process_lockfile(path)
+        app.write_pinned(tmp_dir)
+        self.assertEqual(app.dependency_list['rails'].parent, ['app'])
+        self.assertEqual(app.dependency_list['rack'].parent, ['rails'])
+        with open(os.path.join(tmp_dir, 'pinned.json')) as f:
+            self.assertEqual(json.load(f), {'rack': '2.0.1',
+                                            'rails': '5.0.0'})
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp_dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_read_manifest(self):
+        path = self.write('apps.txt', '# apps\n\nshop shop/Gemfile\n'
+                          'blog/Gemfile\n')
+        batch = GemDepsBatch(archive=FakeArchive(), client=object())
+        self.assertEqual(batch.read_manifest(path),
+                         [('shop', os.path.join(self.tmp_dir,
+                                                'shop/Gemfile')),
+                          ('blog', os.path.join(self.tmp_dir,
+                                                'blog/Gemfile'))])
+
+    @unittest.skipIf(gemfileparser is None, "needs gemfileparser")
+    def test_one_directory_per_app(self):
+        self.write('shop/Gemfile', "gem 'rails'\n")
+        self.write('blog/Gemfile', "gem 'rack'\n")
+        manifest = self.write('apps.txt', 'shop/Gemfile\nblog/Gemfile\n')
+        client = FakeClient({'rack': RACK, 'rails': RAILS})
+        batch = GemDepsBatch(archive=FakeArchive(), client=client)
+        batch.process(batch.read_manifest(manifest))
+        out_dir = os.path.join(self.tmp_dir, 'out')
+        batch.write_output(out_dir)
+        self.assertEqual(sorted(os.listdir(out_dir)), ['blog', 'shop'])
+        with open(os.path.join(out_dir, 'shop', 'debian_status.json')) as f:
+            self.assertEqual(sorted(json.load(f)), ['rack', 'rails'])
+        with open(os.path.join(out_dir, 'blog', 'debian_status.json')) as f:
+            self.assertEqual(sorted(json.load(f)), ['rack'])
+        self.assertTrue(os.path.exists(os.path.join(out_dir, 'blog',
+                                                    'graph.dot')))
+        # rack is looked up once for both apps
+        self.assertEqual(len(client.requests), 2)
+        self.assertIs(batch.apps['shop'].metrics, batch.metrics)
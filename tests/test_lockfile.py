@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+
+from gemdeps.lockfile import Lockfile
+
+LOCKFILE = '''GEM
+  remote: https://rubygems.org/
+  specs:
+    nokogiri (1.10.10-x86_64-linux)
+      racc (~> 1.4)
+    nokogiri (1.10.10)
+      mini_portile2 (~> 2.4.0)
+    rack (2.0.1)
+    sqlite3 (1.4.2-x86_64-linux)
+    sqlite3 (1.4.2-arm64-darwin)
+      mini_portile2 (~> 2.4.0)
+
+PLATFORMS
+  ruby
+  x86_64-linux
+
+DEPENDENCIES
+  nokogiri (>= 1.10, < 2)
+  rack!
+  sqlite3
+'''
+
+
+class LockfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(self.tmp_dir, 'Gemfile.lock')
+        with open(path, 'w') as f:
+            f.write(LOCKFILE)
+        self.lockfile = Lockfile(path)
+
+    def test_specs(self):
+        self.assertEqual(self.lockfile.specs['rack'], '2.0.1')
+        self.assertEqual(self.lockfile.graph['rack'], [])
+
+    def test_ruby_platform_is_preferred(self):
+        self.assertEqual(self.lockfile.specs['nokogiri'], '1.10.10')
+        self.assertEqual(self.lockfile.graph['nokogiri'],
+                         [('mini_portile2', ['~> 2.4.0'])])
+
+    def test_first_platform_without_ruby(self):
+        self.assertEqual(self.lockfile.specs['sqlite3'], '1.4.2')
+        self.assertEqual(self.lockfile.graph['sqlite3'], [])
+
+    def test_dependencies(self):
+        self.assertEqual(self.lockfile.dependencies,
+                         [('nokogiri', ['>= 1.10', '< 2']),
+                          ('rack', []), ('sqlite3', [])])
@@ -0,0 +1,85 @@
+import random
+import types
+import unittest
+
+from gemdeps import GemDeps
+from gemdeps.matching import MatchingPool
+
+OPERATORS = ['>=', '>', '<', '<=', '~>', '=', '!=']
+
+
+def make_payloads(rng, gems, versions):
+    '''
+    Returns random Rubygems information of gems, with prereleases and
+    platform builds, and the requirements of their dependencies.
+    '''
+    names = ['gem%d' % number for number in range(gems)]
+    numbers = {}
+    for name in names:
+        numbers[name] = sorted(set(
+            '%d.%d.%d%s' % (rng.randint(0, 3), rng.randint(0, 5),
+                            rng.randint(0, 5),
+                            rng.choice(['', '', '', '.rc1', '.beta2']))
+            for number in range(versions)))
+    payloads = {}
+    requirements = []
+    for name in names:
+        payload = []
+        for number in numbers[name]:
+            dependencies = []
+            for other in rng.sample(names, 2):
+                requirement = '%s %s' % (rng.choice(OPERATORS),
+                                         rng.choice(numbers[other]))
+                if rng.random() < 0.3:
+                    requirement = requirement + ', < 3'
+                dependencies.append([other, requirement])
+                requirements.append(
+                    (other, tuple(x.strip()
+                                  for x in requirement.split(','))))
+            payload.append({'name': name, 'number': number,
+                            'platform': 'ruby',
+                            'dependencies': dependencies})
+            if rng.random() < 0.1:
+                payload.append({'name': name, 'number': number,
+                                'platform': 'java', 'dependencies': []})
+        payloads[name] = payload
+    return payloads, requirements
+
+
+class MatchingPoolTest(unittest.TestCase):
+
+    def test_same_as_serial(self):
+        payloads, requirements = make_payloads(random.Random(7), 30, 15)
+        pool = MatchingPool(2)
+        self.addCleanup(pool.close)
+        selected = pool.select(requirements, payloads.__getitem__)
+        app = GemDeps('app', archive=object(), client=object())
+        for name, requirement in requirements:
+            gem = types.SimpleNamespace(name=name, requirement=requirement)
+            try:
+                expected = app.smallest_satisfiable(payloads[name], gem)
+            except ValueError:
+                self.assertIsNone(selected[(name, requirement)])
+                continue
+            version, dependencies = selected[(name, requirement)]
+            self.assertEqual(version, expected['number'])
+            self.assertEqual([list(x) for x in dependencies],
+                             expected['dependencies'])
+        self.assertTrue(any(x is None for x in selected.values()))
+        self.assertTrue(any(x is not None for x in selected.values()))
+
+    def test_payloads_are_built_once(self):
+        payloads, requirements = make_payloads(random.Random(3), 5, 5)
+        pool = MatchingPool(1)
+        self.addCleanup(pool.close)
+        asked = []
+
+        def get_gem_info(name):
+            asked.append(name)
+            return payloads[name]
+        pool.select(requirements[:10], get_gem_info)
+        pool.select(requirements, get_gem_info)
+        self.assertEqual(sorted(asked), sorted(set(asked)))
+        pool.clear()
+        pool.select(requirements[:1], get_gem_info)
+        self.assertEqual(asked.count(requirements[0][0]), 2)
@@ -0,0 +1,73 @@
+import unittest
+
+from gemdeps.resolver import Resolver
+from gemdeps.util import VersionIndex
+
+
+def make_resolver(gems, **kwargs):
+    '''
+    Returns a Resolver over gems, a map of gem name to a map of version to
+    (name, requirement) dependencies.
+    '''
+    indexes = {}
+    for name, versions in gems.items():
+        version_list = dict(
+            (version, {'number': version, 'dependencies': dependencies})
+            for version, dependencies in versions.items())
+        indexes[name] = (VersionIndex(version_list), version_list)
+    return Resolver(indexes.__getitem__, **kwargs)
+
+
+class ResolverTest(unittest.TestCase):
+
+    def test_lowest_and_highest(self):
+        gems = {'rails': {'4.2.0': [('rack', '~> 1.6')],
+                          '5.0.0': [('rack', '~> 2.0')]},
+                'rack': {'1.6.4': [], '2.0.1': [], '2.0.3': []}}
+        self.assertEqual(make_resolver(gems).resolve([('rails', ())]),
+                         {'rails': '4.2.0', 'rack': '1.6.4'})
+        self.assertEqual(make_resolver(gems, prefer='highest').resolve(
+            [('rails', ())]), {'rails': '5.0.0', 'rack': '2.0.3'})
+
+    def test_backtracks_on_conflict(self):
+        # The smallest rails needs an old rack that sinatra does not allow
+        gems = {'app': {'1.0': [('rails', '>= 4.0'),
+                                ('sinatra', '>= 0')]},
+                'rails': {'4.2.0': [('rack', '~> 1.6')],
+                          '4.2.1': [('rack', '~> 1.6')],
+                          '5.0.0': [('rack', '~> 2.0')]},
+                'sinatra': {'2.0.0': [('rack', '~> 2.0')]},
+                'rack': {'1.6.4': [], '2.0.1': []}}
+        resolver = make_resolver(gems)
+        self.assertEqual(resolver.resolve([('app', ())]),
+                         {'app': '1.0', 'rails': '5.0.0',
+                          'sinatra': '2.0.0', 'rack': '2.0.1'})
+
+    def test_no_solution(self):
+        gems = {'rails': {'5.0.0': [('rack', '~> 2.0')]},
+                'sinatra': {'1.4.0': [('rack', '~> 1.5')]},
+                'rack': {'1.6.4': [], '2.0.1': []}}
+        with self.assertRaises(ValueError):
+            make_resolver(gems).resolve([('rails', ()), ('sinatra', ())])
+
+    def test_gemfile_requirements(self):
+        gems = {'rack': {'1.6.4': [], '2.0.1': [], '2.0.1.rc1': []}}
+        self.assertEqual(make_resolver(gems).resolve([('rack', ('>= 2',))]),
+                         {'rack': '2.0.1'})
+        with self.assertRaises(ValueError):
+            make_resolver(gems).resolve([('rack', ('~> 1.6',)),
+                                         ('rack', ('>= 2',))])
+
+    def test_long_chain(self):
+        # Each gem depends on the next one, with many versions each
+        gems = {}
+        for number in range(300):
+            dependencies = []
+            if number < 299:
+                dependencies = [('gem%d' % (number + 1), '>= 1.5')]
+            gems['gem%d' % number] = dict(
+                ('%d.%d' % (major, minor), dependencies)
+                for major in range(1, 4) for minor in range(10))
+        pinned = make_resolver(gems).resolve([('gem0', ())])
+        self.assertEqual(len(pinned), 300)
+        self.assertEqual(pinned['gem299'], '1.5')
@@ -0,0 +1,165 @@
+import gzip
+import os
+import tempfile
+import time
+import unittest
+from http.client import HTTPException
+
+from gemdeps.rubygems import CompactIndex, RubygemsClient, parse_info
+from stand_in import start_server
+
+INFO = '''---
+1.0.0 |checksum:aaa
+1.1.0 rack:>= 1.0&< 3,json:~> 1.8|checksum:bbb,ruby:>= 2.2.2
+1.1.0-java rack:>= 1.0&< 3,jruby-openssl:>= 0|checksum:ccc
+2.0.0.rc1 rack:~> 2.0|checksum:ddd,rubygems:> 1.3.1
+'''
+
+
+class ParseInfoTest(unittest.TestCase):
+
+    def test_versions(self):
+        versions = parse_info('sinatra', INFO)
+        self.assertEqual([(x['number'], x['platform']) for x in versions],
+                         [('1.0.0', 'ruby'), ('1.1.0', 'ruby'),
+                          ('1.1.0', 'java'), ('2.0.0.rc1', 'ruby')])
+        for version in versions:
+            self.assertEqual(version['name'], 'sinatra')
+
+    def test_dependencies(self):
+        versions = parse_info('sinatra', INFO)
+        self.assertEqual(versions[0]['dependencies'], [])
+        self.assertEqual(versions[1]['dependencies'],
+                         [['rack', '>= 1.0, < 3'], ['json', '~> 1.8']])
+        self.assertEqual(versions[2]['dependencies'],
+                         [['rack', '>= 1.0, < 3'],
+                          ['jruby-openssl', '>= 0']])
+        self.assertEqual(versions[3]['dependencies'], [['rack', '~> 2.0']])
+
+    def test_empty(self):
+        self.assertEqual(parse_info('sinatra', ''), [])
+        self.assertEqual(parse_info('sinatra', '---\n'), [])
+
+
+class CompactIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.tmp_dir, 'compact.db')
+
+    def mirror(self, name, infos):
+        info_dir = os.path.join(self.tmp_dir, name, 'info')
+        os.makedirs(info_dir)
+        for gem, text in infos.items():
+            with open(os.path.join(info_dir, gem), 'w') as f:
+                f.write(text)
+        return os.path.dirname(info_dir)
+
+    def test_without_index(self):
+        path = self.mirror('mirror', {'sinatra': INFO})
+        index = CompactIndex(path)
+        self.assertEqual(index.get('sinatra'), parse_info('sinatra', INFO))
+        self.assertEqual(index.get('rails'), [])
+        self.assertFalse(os.path.exists(self.index_path))
+
+    def test_index(self):
+        infos = dict(('gem%03d' % number, '---\n1.%d |checksum:a\n' % number)
+                     for number in range(100))
+        infos['sinatra'] = INFO
+        path = self.mirror('mirror', infos)
+        # The info directory itself can be given too
+        for index_path in (self.index_path, self.index_path + '2'):
+            index = CompactIndex(path, index_path)
+            self.assertEqual(index.get('sinatra'),
+                             parse_info('sinatra', INFO))
+            for number in range(100):
+                self.assertEqual(index.get('gem%03d' % number)[0]['number'],
+                                 '1.%d' % number)
+            self.assertEqual(index.get('gem'), [])
+            self.assertEqual(index.get('zzz'), [])
+            path = os.path.join(path, 'info')
+
+    def test_index_is_rebuilt_for_changed_info(self):
+        path = self.mirror('mirror', {'rack': '---\n1.0 |checksum:a\n'})
+        CompactIndex(path, self.index_path)
+        inode = os.stat(self.index_path).st_ino
+        CompactIndex(path, self.index_path)
+        self.assertEqual(os.stat(self.index_path).st_ino, inode)
+        info_path = os.path.join(path, 'info', 'rack')
+        with open(info_path, 'a') as f:
+            f.write('2.0 |checksum:b\n')
+        index = CompactIndex(path, self.index_path)
+        self.assertEqual([x['number'] for x in index.get('rack')],
+                         ['1.0', '2.0'])
+        with open(os.path.join(path, 'info', 'json'), 'w') as f:
+            f.write('---\n2.0.2 |checksum:c\n')
+        index = CompactIndex(path, self.index_path)
+        self.assertEqual(index.get('json')[0]['number'], '2.0.2')
+
+    def test_index_is_rebuilt_for_another_mirror(self):
+        first = self.mirror('first', {'rack': '---\n1.0 |checksum:a\n'})
+        second = self.mirror('second', {'rack': '---\n2.0 |checksum:b\n'})
+        CompactIndex(first, self.index_path)
+        index = CompactIndex(second, self.index_path)
+        self.assertEqual([x['number'] for x in index.get('rack')], ['2.0'])
+
+
+class RubygemsClientTest(unittest.TestCase):
+
+    def test_gzip(self):
+        server = start_server(self, default=(
+            200, {'Content-Encoding': 'gzip'}, gzip.compress(b'[]')))
+        client = RubygemsClient(server.url + '/mirror/')
+        self.assertEqual(client.get('/api?gems=rack')[2], b'[]')
+        path, headers = server.requests[0]
+        self.assertEqual(path, '/mirror/api?gems=rack')
+        self.assertEqual(headers['Accept-Encoding'], 'gzip')
+        self.assertEqual(client.metrics.counters['rubygems_bytes'],
+                         len(gzip.compress(b'[]')))
+
+    def test_connections_are_reused(self):
+        server = start_server(self)
+        client = RubygemsClient(server.url)
+        for number in range(3):
+            client.get('/api')
+        self.assertEqual(client.pool.qsize(), 1)
+
+    def test_server_errors_are_retried(self):
+        server = start_server(self, [(503, {}, b''),
+                                     (429, {'Retry-After': '0'}, b'')])
+        client = RubygemsClient(server.url, backoff=0.01)
+        self.assertEqual(client.get('/api')[0], 200)
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(client.metrics.counters['rubygems_retries'], 2)
+
+    def test_retries_are_limited(self):
+        server = start_server(self, default=(503, {}, b''))
+        client = RubygemsClient(server.url, retries=2, backoff=0.01)
+        self.assertEqual(client.get('/api')[0], 503)
+        self.assertEqual(len(server.requests), 3)
+
+    def test_closed_connections_are_retried(self):
+        server = start_server(self, [None])
+        client = RubygemsClient(server.url, backoff=0.01)
+        self.assertEqual(client.get('/api')[0], 200)
+        self.assertEqual(len(server.requests), 2)
+        server = start_server(self, default=None)
+        client = RubygemsClient(server.url, retries=1, backoff=0.01)
+        with self.assertRaises((HTTPException, OSError)):
+            client.get('/api')
+
+    def test_backoff(self):
+        client = RubygemsClient(backoff=1.0)
+        for attempt in range(4):
+            delay = client.retry_delay(attempt)
+            self.assertGreaterEqual(delay, 0.5 * 2 ** attempt)
+            self.assertLessEqual(delay, 1.5 * 2 ** attempt)
+        self.assertEqual(client.retry_delay(0, {'Retry-After': '7'}), 7)
+
+    def test_rate(self):
+        server = start_server(self)
+        client = RubygemsClient(server.url, rate=20)
+        start = time.time()
+        for number in range(5):
+            client.get('/api')
+        self.assertGreaterEqual(time.time() - start, 0.19)
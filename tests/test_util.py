@@ -0,0 +1,69 @@
+import unittest
+
+from gemdeps.util import (VersionIndex, bump_key, merge_requirements,
+                          version_key, version_satisfy_requirement)
+
+
+class VersionTest(unittest.TestCase):
+
+    def test_order(self):
+        versions = ['1.0', '1.0.a', '0.9', '1.0.0.rc1', '1.0.1']
+        self.assertEqual(sorted(versions, key=version_key),
+                         ['0.9', '1.0.a', '1.0.0.rc1', '1.0', '1.0.1'])
+        self.assertEqual(version_key('1.0'), version_key('1'))
+        self.assertEqual(version_key('1.0.a'), version_key('1.a'))
+
+    def test_bump(self):
+        self.assertEqual(bump_key('1.2.3'), version_key('1.3'))
+        self.assertEqual(bump_key('1.2'), version_key('2'))
+        self.assertEqual(bump_key('1'), version_key('2'))
+
+    def test_bump_prerelease(self):
+        # Rubygems cuts a prerelease at its first string before bumping
+        self.assertEqual(bump_key('5.0.0.beta1'), version_key('5.1'))
+        self.assertEqual(bump_key('5.0.beta1'), version_key('6'))
+        self.assertEqual(bump_key('1.2.3-rc.1'), version_key('1.3'))
+
+
+class RequirementTest(unittest.TestCase):
+
+    def check(self, requirement, version):
+        return version_satisfy_requirement(requirement, version)
+
+    def test_pessimistic(self):
+        self.assertTrue(self.check(['~> 2.0'], '2.5'))
+        self.assertFalse(self.check(['~> 2.0'], '3.0'))
+        self.assertTrue(self.check(['~> 2.0.1'], '2.0.9'))
+        self.assertFalse(self.check(['~> 2.0.1'], '2.1'))
+
+    def test_pessimistic_prerelease(self):
+        self.assertTrue(self.check(['~> 5.0.0.beta1'], '5.0.0.beta2'))
+        self.assertTrue(self.check(['~> 5.0.0.beta1'], '5.0.0'))
+        self.assertTrue(self.check(['~> 5.0.0.beta1'], '5.0.1'))
+        self.assertFalse(self.check(['~> 5.0.0.beta1'], '5.1.0'))
+        self.assertFalse(self.check(['~> 5.0.0.beta1'], '5.0.0.alpha'))
+        self.assertTrue(self.check(['~> 5.0.beta1'], '5.9'))
+        self.assertFalse(self.check(['~> 5.0.beta1'], '6.0'))
+
+    def test_merge(self):
+        self.assertEqual(merge_requirements(('~> 5.0',), ('= 5.0.0',)),
+                         ('= 5.0.0',))
+        self.assertIsNone(merge_requirements(('~> 2.0',), ('>= 3',)))
+
+    def test_merge_pessimistic_prerelease(self):
+        self.assertIsNotNone(merge_requirements(('~> 5.0.0.beta1',),
+                                                ('>= 5.0.1',)))
+        self.assertIsNone(merge_requirements(('~> 5.0.0.beta1',),
+                                             ('>= 5.1',)))
+
+
+class VersionIndexTest(unittest.TestCase):
+
+    def test_least(self):
+        index = VersionIndex(['1.0', '1.1.rc1', '1.1', '2.0', '2.1'])
+        self.assertEqual(index.least(['>= 1.0.1']), '1.1')
+        self.assertEqual(index.least(['>= 1.1.a']), '1.1.rc1')
+        self.assertEqual(index.least(['~> 2.0', '> 2.0']), '2.1')
+        self.assertIsNone(index.least(['> 3']))
+        self.assertEqual(index.highest(['< 2']), '1.1')
+        self.assertEqual(index.satisfying(['~> 1.0']), ['1.0', '1.1'])